@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+import os.path
+import os
+import json
+import yaml
+import argparse
+import logging
+import platform
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import fakecamera
+from dado import Dado
+from scheduler import PRIORITY_EVENT, PRIORITY_THUMBNAIL
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+STAGES = ["listing", "events", "thumbnails", "motion", "download", "merge"]
+
+
+class Benchmark:
+    """Times full Dado cycles against a fake camera, stage by stage.
+
+    Each stage is timed by wrapping the methods that implement it, counting
+    the items it handled and the files and bytes it downloaded. Merges run
+    in the background, so their time is the sum over all merges rather than
+    time added to the cycle.
+    """
+
+    def __init__(self, dado):
+        self.dado = dado
+        self.lock = threading.Lock()
+        self.reset()
+
+        camera = dado.camera
+        camera.list_recordings = self.timed("listing", camera.list_recordings, len)
+        camera.list_events = self.timed("listing", camera.list_events, len)
+        camera.download_files = self.timed_download(camera.download_files)
+        dado.motion.calculate_differences = self.timed("motion", dado.motion.calculate_differences)
+        dado.motion.identify_requests = self.timed("motion", dado.motion.identify_requests, count=False)
+        dado.merge_recordings = self.timed("merge", dado.merge_recordings)
+
+    def reset(self):
+        self.stages = {stage: {"seconds": 0.0, "items": 0, "files": 0, "bytes": 0} for stage in STAGES}
+
+    def add(self, stage, seconds, items=0, files=0, size=0):
+        with self.lock:
+            self.stages[stage]['seconds'] += seconds
+            self.stages[stage]['items'] += items
+            self.stages[stage]['files'] += files
+            self.stages[stage]['bytes'] += size
+
+    def timed(self, stage, function, measure=None, count=True):
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            result = function(*args, **kwargs)
+            items = 0
+            if count and measure:
+                items = measure(result) if result else 0
+            elif count and args:
+                items = len(args[0]['recordings']) if isinstance(args[0], dict) else len(args[0])
+            self.add(stage, time.perf_counter() - started, items)
+            return result
+        return wrapper
+
+    def timed_download(self, function):
+        scheduler = self.dado.camera.scheduler
+
+        def wrapper(list, key, local_key, priority, *args):
+            if priority == PRIORITY_EVENT:
+                stage = "events"
+            elif priority == PRIORITY_THUMBNAIL:
+                stage = "thumbnails"
+            else:
+                stage = "download"
+            (files, size) = (scheduler.files, scheduler.bytes)
+            started = time.perf_counter()
+            result = function(list, key, local_key, priority, *args)
+            self.add(stage, time.perf_counter() - started, len(list), scheduler.files - files, scheduler.bytes - size)
+            return result
+        return wrapper
+
+    def run_cycle(self):
+        self.reset()
+        (reachable, files, duration) = self.dado.run_pass()
+
+        stages = {}
+        for (stage, totals) in self.stages.items():
+            seconds = totals['seconds']
+            stages[stage] = dict(totals,
+                                 items_per_second=totals['items'] / seconds if seconds > 0 else None,
+                                 mb_per_second=totals['bytes'] / seconds / 1048576 if seconds > 0 and totals['bytes'] else None)
+        return {"reachable": reachable, "seconds": duration, "stages": stages, "metrics": registry.summary()}
+
+
+def report(number, cycle):
+    logger.info("Cycle {} took {:.2f}s".format(number, cycle['seconds']))
+    for (stage, totals) in cycle['stages'].items():
+        rates = []
+        if totals['items_per_second'] is not None:
+            rates.append("{:.1f} items/s".format(totals['items_per_second']))
+        if totals['mb_per_second'] is not None:
+            rates.append("{:.2f} MB/s".format(totals['mb_per_second']))
+        logger.info("  {:<10} {:>8.2f}s {:>6} items {:>5} files {:>8.1f} MB  {}".format(
+            stage, totals['seconds'], totals['items'], totals['files'], totals['bytes'] / 1048576, ", ".join(rates)))
+
+
+def make_config(template, output_root, port, overrides):
+    with open(template, 'r') as file:
+        config = yaml.load(file, Loader=yaml.SafeLoader)
+    config['output_root'] = output_root
+    config['camera']['address'] = "127.0.0.1"
+    config['camera']['port'] = port
+    # Metrics are included in the results rather than served
+    config.setdefault('metrics', {})['port'] = None
+    for override in overrides:
+        (key, value) = override.split("=", 1)
+        section = config
+        path = key.split(".")
+        for part in path[:-1]:
+            section = section.setdefault(part, {})
+        section[path[-1]] = yaml.load(value, Loader=yaml.SafeLoader)
+    path = os.path.join(output_root, "benchmark.yaml")
+    with open(path, 'w') as file:
+        yaml.dump(config, file)
+    return (path, config)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark Dado cycles against a fake camera")
+    parser.add_argument("-c", "--config", default="config.yaml.sample",
+                        help="Config file to base the run on, the camera address and output_root are replaced")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="Override a config value, e.g. motion_detection.engine=fast")
+    parser.add_argument("--cycles", type=int, default=2, help="Number of cycles to run, the first starts with no files")
+    parser.add_argument("--output", default="benchmark.json", help="File to write the results to as JSON")
+    parser.add_argument("--keep", action="store_true", help="Keep the downloaded files")
+    fakecamera.add_arguments(parser)
+    args = parser.parse_args()
+
+    started = datetime.now()
+    camera = fakecamera.from_arguments(args)
+    port = camera.serve()
+    output_root = tempfile.mkdtemp(prefix="dado-benchmark-")
+    (config_file, config) = make_config(args.config, output_root, port, args.set)
+
+    dado = Dado(config_file)
+    benchmark = Benchmark(dado)
+    cycles = []
+    try:
+        for number in range(1, args.cycles + 1):
+            cycle = benchmark.run_cycle()
+            report(number, cycle)
+            cycles.append(cycle)
+    finally:
+        dado.camera.close()
+        camera.shutdown()
+        if not args.keep:
+            shutil.rmtree(output_root, ignore_errors=True)
+
+    results = {"started": started.isoformat(),
+               "python": platform.python_version(),
+               "camera": {key: value for (key, value) in vars(args).items() if key not in ("config", "output", "keep", "set")},
+               "overrides": args.set,
+               "camera_class": config['camera']['class'],
+               "motion_engine": config['motion_detection'].get('engine', 'legacy'),
+               "requests_served": camera.requests,
+               "bytes_served": camera.bytes_sent,
+               "cycles": cycles}
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=1)
+    logger.info("Results written to {}".format(args.output))
@@ -9,10 +9,16 @@ import re
 
 from requests.adapters import HTTPAdapter
 from datetime import datetime, timezone, timedelta
-from operator import itemgetter
 from json.decoder import JSONDecodeError
+from concurrent.futures import as_completed
 
 from util import plural
+from scheduler import DownloadScheduler, PRIORITY_ORIGINAL, CLASSES
+from metrics import registry
+from ratelimit import RateLimiter
+from intervalindex import IntervalIndex
+from catalog import RecordingCatalog
+from inventory import LocalInventory
 
 logger = logging.getLogger(__name__)
 
@@ -34,6 +40,22 @@ class DDPAI:
         self.session_reliable.mount(self.get_http_endpoint(), HTTPAdapter(max_retries=self.config['http_retries']))
         self.timeout = self.config.get('http_timeout', 60)
 
+        # The catalog of the previous listing, see reuse_known_recordings()
+        self.known_recordings = None
+        self.known_offset = None
+
+        # Downloads are run by a small pool of workers, limited to avoid overloading the camera
+        self.scheduler = DownloadScheduler(self.config.get('download_workers', 1))
+        self.limiter = RateLimiter(self.config.get('rate_limit'))
+
+        # The files already downloaded, read once per pass
+        self.inventory = LocalInventory()
+
+    def close(self):
+        """Release the connections to the camera, which are opened again if it is used afterwards."""
+        self.session.close()
+        self.session_reliable.close()
+
     def get_http_endpoint(self):
         return "http://{}:{}".format(self.config['address'], self.config['port'])
 
@@ -43,8 +65,8 @@ class DDPAI:
     def get_download_url(self, filename):
         return self.get_http_endpoint() + "/{}".format(filename)
 
-    def auth(self):
-        (response, duration, ts) = self.request(self.get_api_url("API_RequestSessionID"), session=self.session)
+    def auth(self, timeout=None):
+        (response, duration, ts) = self.request(self.get_api_url("API_RequestSessionID"), session=self.session, timeout=timeout)
         if response:
             data = self.json(response)
             self.sessionid = data.get('acSessionId', None)
@@ -96,7 +118,7 @@ class DDPAI:
             return None
         return data
 
-    def request(self, url, method='GET', data='', session=None):
+    def request(self, url, method='GET', data='', session=None, timeout=None):
         logger.debug("Making request for: {}".format(url))
 
         if not session:
@@ -109,7 +131,7 @@ class DDPAI:
             headers['sessionid'] = self.sessionid
         dict(cookies_are='working')
         try:
-            response = self.session.request(method, url, data=data, headers=headers, timeout=self.timeout)
+            response = self.session.request(method, url, data=data, headers=headers, timeout=timeout or self.timeout)
             timestamp = datetime.strptime(response.headers['Date'], HTTP_DATE_FORMAT)
         except (requests.ConnectionError, requests.exceptions.ReadTimeout) as e:
             logger.info("Camera not available")
@@ -123,61 +145,196 @@ class DDPAI:
         logger.info("Querying camera for list of recordings..")
 
         (response, duration, ts) = self.request(self.get_api_url("APP_PlaybackListReq"), method='POST', data="{}")
-        if response:
-            data = self.json(response)
-            if data:
-                logger.info("{} file{} found in {:.2f}s".format(data['num'], plural(data['num']), duration.total_seconds()))
-                return data.get('file')
-        return None
+        return self.parse_listing(response, duration, "file", "file")
 
     def list_events(self):
         logger.info("Querying camera for list of events..")
 
         (response, duration, ts) = self.request(self.get_api_url("APP_EventListReq"), method='POST', data="{}")
+        return self.parse_listing(response, duration, "event", "event")
+
+    def parse_listing(self, response, duration, key, description):
         if response:
             data = self.json(response)
             if data:
-                logger.info("{} event{} found in {:.2f}s".format(data['num'], plural(data['num']), duration.total_seconds()))
-                return data.get('event')
+                logger.info("{} {}{} found in {:.2f}s".format(data['num'], description, plural(data['num']), duration.total_seconds()))
+                return data.get(key)
         return None
 
-    def download_files(self, list, key, local_key):
+    def download_files(self, list, key, local_key, priority=PRIORITY_ORIGINAL):
+        pending = self.pending_downloads(list, key, local_key)
+        self.limiter.apply()
+        futures = {}
+        for file in pending:
+            futures[self.scheduler.submit(priority, self.timed_download, file[key], file[local_key], priority)] = file
+
         count = 1
+        for future in as_completed(futures):
+            file = futures[future]
+            try:
+                (size, duration) = future.result()
+            except Exception as e:
+                logger.error("Error downloading {}: {}".format(file[key], e))
+                (size, duration) = (None, None)
+            self.download_finished(file, key, size, duration, count, len(pending), priority)
+            count += 1
+        return list
+
+    def pending_downloads(self, list, key, local_key):
+        """Return the files in list that have not been downloaded yet, creating their directories."""
         skipped = 0
+        pending = []
         for file in list:
-            filename = file[key]
-            localfile = file[local_key]
+            size = self.inventory.size(file[local_key])
 
-            if os.path.isfile(localfile) and os.stat(localfile).st_size > 0:
+            if size:
+                file['download_status'] = 'complete'
+                file['download_size'] = size
                 skipped += 1
-        logger.info("{} file{} already downloaded. {} file{} remaining".format(skipped, plural(skipped), len(list) - skipped, plural(len(list) - skipped)))
-        for file in list:
-            filename = file[key]
-            localfile = file[local_key]
-            directory = os.path.dirname(localfile)
-            if not os.path.exists(directory):
-                logger.debug("Making dir {}".format(directory))
-
-                os.makedirs(directory)
-            if not os.path.isfile(localfile) or os.stat(localfile).st_size == 0:
-
-                (response, duration, ts) = self.request(self.get_download_url(filename))
-                if response:
-                    logger.debug("{}/{}: Downloaded {} in {:.2f}s".format(count, len(list) - skipped, filename,  duration.total_seconds()))
-                    with open(localfile, 'wb') as f:
-                        f.write(response.content)
-                else:
-                    logger.error("Failed to download: {}".format(filename))
-                count += 1
-        return list
+            else:
+                pending.append(file)
+        logger.info("{} file{} already downloaded. {} file{} remaining".format(skipped, plural(skipped), len(pending), plural(len(pending))))
+
+        for file in pending:
+            self.inventory.make_directory(os.path.dirname(file[local_key]))
+        return pending
+
+    def download_finished(self, file, key, size, duration, count, total, priority=PRIORITY_ORIGINAL):
+        if size is not None:
+            logger.debug("{}/{}: Downloaded {} in {:.2f}s".format(count, total, file[key], duration.total_seconds()))
+            file['download_status'] = 'complete'
+            file['download_size'] = size
+            registry.inc("dado_downloaded_files_total", kind=CLASSES[priority])
+            registry.inc("dado_downloaded_bytes_total", size, kind=CLASSES[priority])
+        else:
+            logger.error("Failed to download: {}".format(file[key]))
+            registry.inc("dado_download_failures_total", kind=CLASSES[priority])
+            file['download_status'] = 'failed'
+            file['download_size'] = 0
+
+    def timed_download(self, filename, localfile, priority=PRIORITY_ORIGINAL):
+        start = datetime.now()
+        size = None
+        if self.download_file(filename, localfile, priority):
+            size = os.stat(localfile).st_size
+            self.inventory.add(localfile, size)
+            self.scheduler.record(size)
+        return (size, datetime.now() - start)
+
+    def report_throughput(self):
+        self.limiter.report()
+        return self.scheduler.report()
+
+    def download_file(self, filename, localfile, priority=PRIORITY_ORIGINAL):
+        """Stream a file from the device to disk in chunks.
+
+        Data is written to a partial file which is renamed into place once
+        the expected size has been received. A partial file left behind by
+        a failed attempt or an earlier cycle is resumed with a Range request.
+        Reading is paced by the rate limiter for the priority of the download.
+        """
+        url = self.get_download_url(filename)
+        partfile = localfile + self.config.get('partial_extension', '.part')
+        chunk_size = self.config.get('download_chunk_size', 1048576)
+        attempts = self.config.get('http_retries', 0) + 1
+
+        for attempt in range(attempts):
+            if attempt > 0:
+                registry.inc("dado_download_retries_total")
+            offset = os.stat(partfile).st_size if os.path.isfile(partfile) else 0
+            try:
+                with self.session_reliable.get(url, headers=self.download_headers(filename, offset), stream=True, timeout=self.timeout) as response:
+                    if response.status_code != 416:
+                        response.raise_for_status()
+                    (mode, total) = self.resume_mode(filename, response.status_code, response, offset)
+                    if mode == 'complete':
+                        os.replace(partfile, localfile)
+                        return True
+                    elif mode == 'discard':
+                        os.remove(partfile)
+                        continue
+
+                    self.limiter.start()
+                    try:
+                        with open(partfile, mode) as f:
+                            for chunk in response.iter_content(chunk_size=chunk_size):
+                                f.write(chunk)
+                                self.limiter.throttle(priority, len(chunk))
+                    finally:
+                        self.limiter.finish()
+            except requests.RequestException as e:
+                logger.info("Download of {} failed on attempt {}/{}".format(filename, attempt + 1, attempts))
+                logger.debug("Error reported: {}".format(e))
+                continue
+
+            if self.download_complete(filename, partfile, localfile, total):
+                return True
+        return False
+
+    def download_headers(self, filename, offset):
+        headers = {}
+        if self.sessionid:
+            headers['sessionid'] = self.sessionid
+        if offset > 0:
+            logger.debug("Resuming download of {} from byte {}".format(filename, offset))
+            headers['Range'] = "bytes={}-".format(offset)
+        return headers
+
+    def resume_mode(self, filename, status, response, offset):
+        """Decide how to handle the response to a download request.
+
+        Returns how the partial file should be treated, either 'complete',
+        'discard' or the mode to open it with, and the expected total size.
+        """
+        if status == 416:
+            # Nothing left to send, either the partial file is already
+            # complete or it no longer matches the file on the device
+            total = self.content_range_total(response)
+            if total is not None and total == offset:
+                return ('complete', total)
+            logger.debug("Discarding partial download of {}".format(filename))
+            return ('discard', None)
+
+        if status == 206:
+            if self.content_range_start(response) != offset:
+                logger.debug("Unexpected range returned for {}, restarting download".format(filename))
+                return ('discard', None)
+            return ('ab', self.content_range_total(response))
+
+        # The device ignored the range so the whole file is being sent
+        length = response.headers.get('Content-Length')
+        return ('wb', int(length) if length is not None else None)
+
+    def download_complete(self, filename, partfile, localfile, total):
+        """Move a partial file into place once it has reached the expected size."""
+        size = os.stat(partfile).st_size
+        if total is None or size == total:
+            os.replace(partfile, localfile)
+            return True
+        logger.info("Download of {} incomplete, received {} of {} bytes".format(filename, size, total))
+        return False
+
+    def content_range_start(self, response):
+        match = re.match(r"bytes (\d+)-\d+/", response.headers.get('Content-Range', ''))
+        return int(match.group(1)) if match else None
+
+    def content_range_total(self, response):
+        match = re.match(r"bytes [\d*-]+/(\d+)", response.headers.get('Content-Range', ''))
+        return int(match.group(1)) if match else None
 
     def find_files(self, extension):
         path = os.path.join(self.config['output_root'], self.config['constant_path'])
         files = self.iterate_path(path, extension)
         return files
 
+    def probe(self):
+        """Check whether the camera is reachable, giving up quickly if it is not."""
+        return self.auth(timeout=self.config.get('probe_timeout', 5))
+
     def initiate(self):
-        if self.auth():
+        # Files may have changed since the last pass, e.g. been removed by retention
+        self.inventory.clear()
+        if self.probe():
             self.requestcert()
             if 'time_set' in self.config and self.config['time_set']:
                 self.settime()
@@ -195,17 +352,28 @@ class DDPAI:
                 self.add_datetime_from_name(event, self.config['date_format'], "filename")
 
     def prepare_recordings(self, list):
-        self.add_thumbnail(list)
-        for item in list:
-            self.add_datetime_from_timestamp(item)
+        """Return the listing as a RecordingCatalog, sorted by sort_order if set."""
+        catalog = RecordingCatalog(list, self.utcoffset, self.config['thumbnail_extension'])
+        if self.config.get('incremental_listing'):
+            self.reuse_known_recordings(catalog)
 
         if self.config.get('sort_order', None):
-            list.sort(key=itemgetter(self.config.get('sort_order')))
-        return list
-
-    def add_thumbnail(self, list):
-        for item in list:
-            item['thumbnail'] = item['name'].replace(".mp4", self.config['thumbnail_extension'])
+            catalog = catalog.sorted(self.config.get('sort_order'))
+        return catalog
+
+    def reuse_known_recordings(self, catalog):
+        """Carry over what is known about recordings seen in the previous listing.
+
+        Recordings are matched on name and start time, and are only carried
+        over if their end time and the UTC offset are unchanged.
+        """
+        if self.known_offset != self.utcoffset:
+            self.known_recordings = None
+        reused = catalog.carry_over(self.known_recordings)
+        new = len(catalog) - reused
+        logger.debug("{} new recording{} since the previous listing".format(new, plural(new)))
+        self.known_recordings = catalog
+        self.known_offset = self.utcoffset
 
     def add_datetime_from_name(self, item, format, key):
         num = "".join((re.findall("\\d+", item[key])))
@@ -222,11 +390,9 @@ class DDPAI:
             item['enddatetime'] = item['startdatetime']
 
     def download_requests(self, listing, requested_times):
+        index = IntervalIndex(listing)
         for (start, finish) in requested_times:
-            matching_recordings = []
-            for recording in listing:
-                if recording['enddatetime'] >= start['startdatetime'] and recording['startdatetime'] <= finish['enddatetime']:
-                    matching_recordings.append(recording)
+            matching_recordings = index.overlapping(start['startdatetime'], finish['enddatetime'])
             logger.debug("Requesting download of {} recordings".format(len(matching_recordings)))
             downloaded = self.download_files(matching_recordings, "name", "local_original")
             logger.debug("Downloaded {} recordings".format(len(downloaded)))
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import os.path
+import os
+
+import aiohttp
+
+from datetime import datetime
+
+from cameras.ddpai import DDPAI, HTTP_DATE_FORMAT
+from scheduler import PRIORITY_ORIGINAL, MIN_WORKERS, MAX_WORKERS
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+
+class Response:
+    """The parts of a requests response used by DDPAI, read from an aiohttp response."""
+
+    def __init__(self, status_code, headers, text):
+        self.status_code = status_code
+        self.headers = headers
+        self.text = text
+
+    def __bool__(self):
+        return self.status_code < 400
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class PrioritySemaphore:
+    """A semaphore that wakes the waiter with the lowest priority number first."""
+
+    def __init__(self, value):
+        self.value = value
+        self.waiters = []
+        self.sequence = itertools.count()
+
+    async def acquire(self, priority):
+        if self.value > 0 and not self.waiters:
+            self.value -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.sequence), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over as the waiter was cancelled, pass it on
+                self.release()
+            raise
+
+    def release(self):
+        while self.waiters:
+            (priority, sequence, future) = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.value += 1
+
+
+class AsyncDDPAI(DDPAI):
+    """A DDPAI camera client running on an asyncio event loop.
+
+    Offers the same interface as DDPAI so it can be selected through the
+    camera module and class settings, with each method running its
+    coroutine to completion. The coroutines are also available directly
+    so listings, thumbnails and downloads can be overlapped on one thread.
+    Connections are reused through a single aiohttp session limited to
+    download_workers connections, requests are given a deadline and
+    downloads still in progress when download_deadline passes are
+    cancelled, leaving the partial file to be resumed later.
+    """
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.loop = asyncio.new_event_loop()
+        self.http = None
+        self.connections = max(MIN_WORKERS, min(MAX_WORKERS, int(self.config.get('download_workers', 1))))
+        self.slots = None
+
+    def run(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    async def get_http(self):
+        if self.http is None:
+            connector = aiohttp.TCPConnector(limit=self.connections)
+            self.http = aiohttp.ClientSession(connector=connector)
+            self.slots = PrioritySemaphore(self.connections)
+        return self.http
+
+    def close(self):
+        if self.http is not None:
+            self.run(self.http.close())
+            self.http = None
+        super().close()
+
+    def request(self, url, method='GET', data='', session=None, timeout=None):
+        return self.run(self.request_async(url, method, data, timeout))
+
+    async def request_async(self, url, method='GET', data='', timeout=None):
+        logger.debug("Making request for: {}".format(url))
+
+        http = await self.get_http()
+        start = datetime.now()
+        response = None
+        timestamp = None
+        headers = {}
+        if self.sessionid:
+            headers['sessionid'] = self.sessionid
+        try:
+            deadline = aiohttp.ClientTimeout(total=timeout or self.timeout)
+            async with http.request(method, url, data=data, headers=headers, timeout=deadline) as reply:
+                response = Response(reply.status, reply.headers, await reply.text(errors='replace'))
+            timestamp = datetime.strptime(response.headers['Date'], HTTP_DATE_FORMAT)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.info("Camera not available")
+            logger.debug("Error reported: {}".format(e))
+        end = datetime.now()
+        elapsed = end - start
+
+        return (response, elapsed, timestamp)
+
+    async def list_recordings_async(self):
+        logger.info("Querying camera for list of recordings..")
+
+        (response, duration, ts) = await self.request_async(self.get_api_url("APP_PlaybackListReq"), method='POST', data="{}")
+        return self.parse_listing(response, duration, "file", "file")
+
+    async def list_events_async(self):
+        logger.info("Querying camera for list of events..")
+
+        (response, duration, ts) = await self.request_async(self.get_api_url("APP_EventListReq"), method='POST', data="{}")
+        return self.parse_listing(response, duration, "event", "event")
+
+    def download_files(self, list, key, local_key, priority=PRIORITY_ORIGINAL):
+        return self.run(self.download_files_async(list, key, local_key, priority))
+
+    async def download_files_async(self, list, key, local_key, priority=PRIORITY_ORIGINAL):
+        await self.get_http()
+        pending = self.pending_downloads(list, key, local_key)
+        self.limiter.apply()
+        downloads = [self.timed_download_async(file, key, local_key, priority) for file in pending]
+
+        count = 1
+        for download in asyncio.as_completed(downloads):
+            (file, size, duration) = await download
+            self.download_finished(file, key, size, duration, count, len(pending), priority)
+            count += 1
+        return list
+
+    async def timed_download_async(self, file, key, local_key, priority):
+        await self.slots.acquire(priority)
+        if self.scheduler.budget is not None:
+            # Wait for a slot shared with other cameras without blocking the event loop
+            await self.loop.run_in_executor(None, self.scheduler.acquire_slot)
+        self.scheduler.job_started()
+        start = datetime.now()
+        size = None
+        deadline = self.config.get('download_deadline')
+        try:
+            if await asyncio.wait_for(self.download_file_async(file[key], file[local_key], priority), deadline):
+                size = os.stat(file[local_key]).st_size
+                self.inventory.add(file[local_key], size)
+                self.scheduler.record(size)
+        except asyncio.TimeoutError:
+            logger.info("Download of {} cancelled after {}s, it will be resumed later".format(file[key], deadline))
+        except Exception as e:
+            logger.error("Error downloading {}: {}".format(file[key], e))
+        finally:
+            self.scheduler.job_finished()
+            self.scheduler.release_slot()
+            self.slots.release()
+        return (file, size, datetime.now() - start)
+
+    async def download_file_async(self, filename, localfile, priority=PRIORITY_ORIGINAL):
+        """Stream a file from the device to disk in chunks, as DDPAI.download_file."""
+        url = self.get_download_url(filename)
+        partfile = localfile + self.config.get('partial_extension', '.part')
+        chunk_size = self.config.get('download_chunk_size', 1048576)
+        attempts = self.config.get('http_retries', 0) + 1
+        deadline = aiohttp.ClientTimeout(total=None, sock_connect=self.timeout, sock_read=self.timeout)
+
+        for attempt in range(attempts):
+            if attempt > 0:
+                registry.inc("dado_download_retries_total")
+            offset = os.stat(partfile).st_size if os.path.isfile(partfile) else 0
+            try:
+                async with self.http.get(url, headers=self.download_headers(filename, offset), timeout=deadline) as response:
+                    if response.status != 416:
+                        response.raise_for_status()
+                    (mode, total) = self.resume_mode(filename, response.status, response, offset)
+                    if mode == 'complete':
+                        os.replace(partfile, localfile)
+                        return True
+                    elif mode == 'discard':
+                        os.remove(partfile)
+                        continue
+
+                    self.limiter.start()
+                    try:
+                        with open(partfile, mode) as f:
+                            async for chunk in response.content.iter_chunked(chunk_size):
+                                f.write(chunk)
+                                await self.throttle(priority, len(chunk))
+                    finally:
+                        self.limiter.finish()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.info("Download of {} failed on attempt {}/{}".format(filename, attempt + 1, attempts))
+                logger.debug("Error reported: {}".format(e))
+                continue
+
+            if self.download_complete(filename, partfile, localfile, total):
+                return True
+        return False
+
+    async def throttle(self, priority, size):
+        """Wait as RateLimiter.throttle does, without blocking the event loop."""
+        delay = self.limiter.reserve(priority, size)
+        if delay > 0:
+            self.limiter.waiting(delay)
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                self.limiter.waited_for()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+
+import math
+from collections.abc import Mapping, MutableMapping, Sequence
+from datetime import datetime
+
+import numpy as np
+
+from formatting import timestamp_format
+
+MISSING = object()
+
+# Codes for the download status column, 0 is not set
+STATUSES = [None, 'complete', 'failed']
+
+# Columns for the values added to recordings as they are processed, with the value stored when they are not set
+STATE_COLUMNS = {
+    'image_diff': (np.float64, np.nan),
+    'download_status': (np.int8, 0),
+    'download_size': (np.int64, -1),
+    'sampled': (np.int8, -1),
+}
+
+# Local times worked out from the timestamps in the listing
+TIMES = {'startdatetime': 'start_epoch', 'enddatetime': 'end_epoch'}
+
+
+class Recording(MutableMapping):
+    """A view of one row of a RecordingCatalog that behaves as a recording dict.
+
+    Values from the listing and the state columns are read from the
+    catalog, the thumbnail name, local times and formatted timestamps are
+    worked out when asked for and anything else set is kept in a dict
+    created for the row on first use.
+    """
+
+    __slots__ = ('catalog', 'row')
+
+    def __init__(self, catalog, row):
+        self.catalog = catalog
+        self.row = row
+
+    def __getitem__(self, key):
+        catalog = self.catalog
+        extras = catalog.extras[self.row]
+        if extras is not None and key in extras:
+            return extras[key]
+        if key in catalog.state:
+            value = catalog.state[key][self.row]
+            if key == 'image_diff':
+                if not math.isnan(value):
+                    return float(value)
+            elif key == 'download_status':
+                if value:
+                    return STATUSES[value]
+            elif value >= 0:
+                return bool(value) if key == 'sampled' else int(value)
+            raise KeyError(key)
+        if key in catalog.columns:
+            value = catalog.columns[key][self.row]
+            if value is MISSING:
+                raise KeyError(key)
+            if key in catalog.strings:
+                return str(value)
+            return value.item() if isinstance(value, np.generic) else value
+        if key in TIMES:
+            return datetime.fromtimestamp(int(catalog.epochs[TIMES[key]][self.row]) - catalog.utcoffset)
+        if key in catalog.formats:
+            (source, format) = catalog.formats[key]
+            if source in TIMES:
+                return format.from_timestamp(int(catalog.epochs[TIMES[source]][self.row]) - catalog.utcoffset)
+            return format(self[source])
+        if key == 'thumbnail' and catalog.thumbnail_extension is not None:
+            return self['name'].replace(".mp4", catalog.thumbnail_extension)
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        catalog = self.catalog
+        if key in catalog.state:
+            if key == 'download_status' and value in STATUSES:
+                catalog.state[key][self.row] = STATUSES.index(value)
+                self.discard_extra(key)
+                return
+            if key != 'download_status' and isinstance(value, (int, float)) and (key == 'image_diff' or value >= 0):
+                catalog.state[key][self.row] = value
+                self.discard_extra(key)
+                return
+        if catalog.extras[self.row] is None:
+            catalog.extras[self.row] = {}
+        catalog.extras[self.row][key] = value
+
+    def discard_extra(self, key):
+        extras = self.catalog.extras[self.row]
+        if extras is not None:
+            extras.pop(key, None)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        catalog = self.catalog
+        self.discard_extra(key)
+        if key in catalog.state:
+            catalog.state[key][self.row] = STATE_COLUMNS[key][1]
+
+    def keys(self):
+        catalog = self.catalog
+        keys = [key for key in catalog.columns if catalog.columns[key][self.row] is not MISSING]
+        keys.extend(TIMES)
+        keys.extend(catalog.formats)
+        if catalog.thumbnail_extension is not None and 'name' in keys:
+            keys.append('thumbnail')
+        keys.extend(key for key in catalog.state if key in self)
+        extras = catalog.extras[self.row]
+        if extras is not None:
+            keys.extend(key for key in extras if key not in keys)
+        return keys
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, Recording):
+            return self.catalog.extras is other.catalog.extras and self.row == other.row
+        return Mapping.__eq__(self, other)
+
+    def __hash__(self):
+        return hash((id(self.catalog.extras), self.row))
+
+    def __repr__(self):
+        return "Recording({})".format(dict(self))
+
+
+class RecordingCatalog(Sequence):
+    """Recordings from a camera listing, held in columns rather than dicts.
+
+    Built from the listing returned by the camera, each field becomes a
+    column: a NumPy array when every value is an integer, otherwise a
+    list. The start and end timestamps are also kept as arrays of epoch
+    seconds so the catalog can be sorted and filtered without looking at
+    each row. Values added as recordings are processed (image_diff, the
+    download status and size and whether the thumbnail was sampled) have
+    columns of their own. Indexing gives a Recording view of a row, which
+    works out the thumbnail name, local times and the timestamps set with
+    set_formats only when asked. Slices and selections are catalogs that
+    share the same columns, so a change through one is seen by all.
+    """
+
+    def __init__(self, listing=(), utcoffset=0, thumbnail_extension=None, startkey="starttime", endkey="endtime"):
+        listing = listing or []
+        self.utcoffset = utcoffset
+        self.thumbnail_extension = thumbnail_extension
+        self.formats = {}
+        self.columns = {}
+        self.strings = set()
+        keys = []
+        for item in listing:
+            keys.extend(key for key in item if key not in keys)
+        for key in keys:
+            self.columns[key] = self.make_column([item.get(key, MISSING) for item in listing], key)
+        start = self.epoch_column(startkey, np.zeros(len(listing), dtype=np.int64))
+        self.epochs = {'start_epoch': start, 'end_epoch': self.epoch_column(endkey, start)}
+        self.state = {key: np.full(len(listing), missing, dtype=dtype) for (key, (dtype, missing)) in STATE_COLUMNS.items()}
+        self.extras = [None] * len(listing)
+        self.rows = np.arange(len(listing))
+
+    def make_column(self, values, key):
+        if all(isinstance(value, int) and not isinstance(value, bool) for value in values):
+            return np.array(values, dtype=np.int64)
+        if all(isinstance(value, str) and value.isdigit() and str(int(value)) == value for value in values):
+            self.strings.add(key)
+            return np.array([int(value) for value in values], dtype=np.int64)
+        return values
+
+    def epoch_column(self, key, fallback):
+        """Return a column as epoch seconds, taking missing values from fallback."""
+        column = self.columns.get(key)
+        if column is None:
+            return fallback
+        if isinstance(column, np.ndarray):
+            return column
+        return np.array([int(value) if value is not MISSING else int(fallback[index]) for (index, value) in enumerate(column)],
+                        dtype=np.int64)
+
+    def view(self, rows):
+        """Return a catalog of the given rows sharing the columns of this one."""
+        catalog = object.__new__(RecordingCatalog)
+        catalog.__dict__.update(self.__dict__)
+        catalog.rows = rows
+        return catalog
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.view(self.rows[index])
+        return Recording(self, int(self.rows[index]))
+
+    def __iter__(self):
+        for row in self.rows.tolist():
+            yield Recording(self, row)
+
+    def column(self, key):
+        """Return the values of a column for the rows of this catalog as an array."""
+        if key in self.epochs:
+            return self.epochs[key][self.rows]
+        if key in self.state:
+            return self.state[key][self.rows]
+        column = self.columns[key]
+        if isinstance(column, np.ndarray):
+            return column[self.rows]
+        return np.array([column[row] for row in self.rows.tolist()], dtype=object)
+
+    def select(self, mask):
+        """Return the rows where mask is true."""
+        return self.view(self.rows[np.asarray(mask, dtype=bool)])
+
+    def sorted(self, key):
+        """Return the catalog sorted by a column, keeping the order of equal values."""
+        values = self.column('start_epoch' if key in ('starttime', 'startdatetime') else key)
+        if len(values) < 2 or (values.dtype != object and (values[1:] >= values[:-1]).all()):
+            return self
+        return self.view(self.rows[np.argsort(values, kind='stable')])
+
+    def starting_after(self, when):
+        """Return the rows that start after the local time when."""
+        starts = self.epochs['start_epoch'][self.rows] - self.utcoffset
+        threshold = when.timestamp()
+        mask = starts > threshold
+        # Local times are ambiguous around a change of daylight saving time, so check those rows one by one
+        close = np.flatnonzero(np.abs(starts - threshold) <= 7200)
+        for index in close.tolist():
+            mask[index] = datetime.fromtimestamp(int(starts[index])) > when
+        return self.select(mask)
+
+    def set_formats(self, formats):
+        """Make timestamps available on every row, given as {key: (datetime key, strftime format)}."""
+        for (key, (source, format)) in formats.items():
+            self.formats[key] = (source, timestamp_format(format))
+
+    def carry_over(self, previous):
+        """Copy what is known about recordings from the previous catalog of the same camera.
+
+        Recordings are matched on name and start time and are only carried
+        over if their end time is unchanged. Returns the number carried over.
+        """
+        if previous is None or 'name' not in self.columns or 'name' not in previous.columns:
+            return 0
+        known = {}
+        for row in previous.rows.tolist():
+            known[(previous.columns['name'][row], int(previous.epochs['start_epoch'][row]))] = row
+        count = 0
+        for row in self.rows.tolist():
+            match = known.get((self.columns['name'][row], int(self.epochs['start_epoch'][row])))
+            if match is not None and previous.epochs['end_epoch'][match] == self.epochs['end_epoch'][row]:
+                for key in self.state:
+                    self.state[key][row] = previous.state[key][match]
+                if previous.extras[match] is not None:
+                    self.extras[row] = dict(previous.extras[match])
+                count += 1
+        return count
@@ -2,120 +2,279 @@
 
 import os.path
 import os
+import json
 import yaml
 import ffmpeg
 import argparse
 import logging
 import importlib
 import re
+import threading
 import time
+from contextlib import nullcontext
+from functools import partial
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from motiondetection import MotionDetection
 from util import plural
+from statestore import StateStore
+from intervalindex import IntervalIndex
+from catalog import RecordingCatalog
+from formatting import PathTemplate, timestamp_format
+from retention import RetentionManager
+from trimming import MotionTrimmer
+from requestwatcher import RequestWatcher
+from polling import PollScheduler
+from metrics import registry, MetricsServer
+from profiling import CycleProfiler
+from fleet import Fleet
+from scheduler import PRIORITY_EVENT, PRIORITY_THUMBNAIL, PRIORITY_ORIGINAL, PRIORITY_BACKFILL
 from pprint import pprint as pprint
 
 
+def load_config(path):
+    with open(path, 'r') as file:
+        return yaml.load(file, Loader=yaml.SafeLoader)
+
+
+def configure_logging(config):
+    numeric_level = getattr(logging, config.get('log_level', 'info').upper(), None)
+    if not isinstance(numeric_level, int):
+        raise ValueError('Invalid log level: %s' % config.get('log_level', 'info'))
+    logging.basicConfig(
+        # With several cameras the threads are named after the camera they work for
+        format='%(asctime)s %(levelname)-8s %(threadName)s %(message)s' if config.get('cameras') else '%(asctime)s %(levelname)-8s %(message)s',
+        level=numeric_level,
+        datefmt='%Y-%m-%d %H:%M:%S')
+    global logger
+    logger = logging.getLogger(__name__)
+
+
 class Dado:
     """Provides a daemon that automatically downloads dashcam recordings.
 
     The daemon interacts with a camera device over a network, identifies
     the important recordings using motion detection and then downloads
     and merges them based on the configuration.
-    """
 
-    def __init__(self, config):
-        with open(config, 'r') as file:
-            self.config = yaml.load(file, Loader=yaml.SafeLoader)
+    config is the path to the configuration file, or the configuration of
+    one camera run by a Fleet, in which case shared holds the workers it
+    shares with the other cameras.
+    """
 
-        numeric_level = getattr(logging, self.config.get('log_level', 'info').upper(), None)
-        if not isinstance(numeric_level, int):
-            raise ValueError('Invalid log level: %s' % self.config.get('log_level', 'info'))
-        logging.basicConfig(
-            format='%(asctime)s %(levelname)-8s %(message)s',
-            level=numeric_level,
-            datefmt='%Y-%m-%d %H:%M:%S')
-        global logger
-        logger = logging.getLogger(__name__)
+    def __init__(self, config, shared=None):
+        if not isinstance(config, dict):
+            config = load_config(config)
+            configure_logging(config)
+        self.config = config
+        self.name = self.config.get('name')
+        self.shared = shared
 
         logger.info("Dado started..")
 
-        self.state = {}
+        self.state = StateStore(os.path.join(self.config['output_root'], self.config.get('state_file', '.dado/state.sqlite')))
 
         camera_module = importlib.import_module(self.config.get('camera').get('module'))
         Camera_class = getattr(camera_module, self.config.get('camera').get('class'))
         self.camera = Camera_class(self.config.get('camera'))
-        self.motion = MotionDetection(self.config.get('motion_detection'), self.state)
+        motion_config = self.config.get('motion_detection')
+        if motion_config.get('fingerprint_cache'):
+            motion_config['fingerprint_cache'] = os.path.join(self.config['output_root'], motion_config['fingerprint_cache'])
+        self.motion = MotionDetection(motion_config, self.state)
+        if shared is not None:
+            self.camera.scheduler.share(shared.downloads, self.name)
+            if motion_config.get('workers', 1) > 1:
+                self.motion.share(shared.motion_pool(), shared.decodes, self.name)
+
+        self.poller = PollScheduler(self.config)
+        metrics_config = self.config.get('metrics') or {}
+        if metrics_config.get('port') and shared is None:
+            MetricsServer(registry, metrics_config.get('address', '127.0.0.1'), metrics_config['port']).start()
+        labels = {'camera': self.name} if shared is not None else {}
+        # With other cameras the number of merges at once is limited by the shared budget
+        self.merger = ThreadPoolExecutor(max_workers=shared.merges.slots if shared is not None else self.config.get('merge_workers', 1),
+                                         thread_name_prefix="{}-merge".format(self.name) if self.name else "merge",
+                                         initializer=partial(registry.bind, **labels))
+        self.merges = []
+        self.backlog = 0
+        self.retention = RetentionManager(self.config, self.state)
+        self.trimmer = MotionTrimmer(self.config, self.motion) if (self.config.get('trimming') or {}).get('enabled') else None
+        # The *_filename templates, parsed on first use
+        self.templates = {}
+        self.retention.index_existing()
+
+        # Set to end the sleep between passes early, e.g. when a manual request arrives
+        self.wake = threading.Event()
+        if self.config.get('process_manual_requests') and self.config.get('manual_request_dir'):
+            inbox = self.manual_request_path()
+            if not os.path.exists(inbox):
+                logger.debug("Making dir {}".format(inbox))
+                os.makedirs(inbox)
+            if self.config.get('manual_request_watch'):
+                RequestWatcher(inbox, self.config['manual_request_extension'], self.wake).start()
 
     def run_daemon(self):
-        while True:
-            # try:
-            if True:
-                if self.camera.initiate():
-
-                    if self.config.get('download_events'):
-                        self.download_events()
-
-                    if self.config.get('download_recordings'):
-                        (filtered_recordings, requested_sequences) = self.identify_recordings()
-                        self.download_recordings(requested_sequences)
-
-                        if self.config.get('force_download_all'):
-                            logger.info("Processing forced download of all recordings..")
-                            all_recordings = [{"recordings": filtered_recordings}]
-                            self.add_paths(all_recordings[0]['recordings'], "original_filename")
-                            self.download_videos(all_recordings)
-
-            # except Exception as e:
-            #     logger.error("Error encountered in the belt and braces exception handler: {}".format(e))
-
-            logger.info("Sleeping for {} seconds".format(self.config.get('sleep_interval')))
-            logger.info("--------------------------------------------------")
+        try:
+            while True:
+                (reachable, files, duration) = self.run_pass()
+
+                (interval, reason) = self.poller.next_interval(reachable, self.backlog, files > 0)
+                self.poller.record(duration, reachable, self.backlog, interval)
+
+                logger.info("Sleeping for {} seconds ({})".format(interval, reason))
+                logger.info("--------------------------------------------------")
+
+                if self.wake.wait(interval):
+                    logger.info("Woken early to process a manual request")
+                self.wake.clear()
+        finally:
+            # A Fleet restarts the daemon after an error, opening the connections again
+            self.camera.close()
+
+    def run_pass(self):
+        """Run and report on one cycle, returning whether the camera was reachable, files downloaded and time taken."""
+        started = time.monotonic()
+        self.backlog = 0
+        registry.start_cycle()
+        reachable = self.run_cycle()
+        (files, size) = self.camera.report_throughput() if reachable else (0, 0)
+        duration = time.monotonic() - started
+        self.report_metrics(reachable)
+        return (reachable, files, duration)
+
+    def run_profiled(self, cycles, output, top):
+        """Run a number of cycles back to back under the profiler, then report and exit."""
+        profiler = CycleProfiler(output, top)
+        registry.listeners.append(profiler)
+        profiler.start()
+        try:
+            for cycle in range(cycles):
+                logger.info("Profiling cycle {}/{}".format(cycle + 1, cycles))
+                self.run_pass()
+        finally:
+            profiler.stop()
+            registry.listeners.remove(profiler)
+            self.camera.close()
+        profiler.write()
+        print(profiler.report())
+
+    def report_metrics(self, reachable):
+        if reachable:
+            registry.set("dado_backlog_files", self.backlog)
+        summary = registry.end_cycle(reachable)
+        if (self.config.get('metrics') or {}).get('summary', True):
+            logger.info("Metrics: {}".format(json.dumps(summary, sort_keys=True)))
+
+    def run_cycle(self):
+        """Run a single pass, returning False if the camera could not be reached."""
+        # try:
+        if True:
+            # Anything held by a pass that did not finish is found again
+            self.state.discard()
+            if not self.camera.initiate():
+                return False
+
+            if self.config.get('download_events'):
+                self.download_events()
 
-            time.sleep(int(self.config.get('sleep_interval')))
+            requested_sequences = []
+            if self.config.get('download_recordings'):
+                (filtered_recordings, requested_sequences) = self.identify_recordings()
+                self.download_recordings(requested_sequences)
+
+                if self.config.get('force_download_all'):
+                    logger.info("Processing forced download of all recordings..")
+                    all_recordings = [{"recordings": filtered_recordings}]
+                    self.add_paths(all_recordings[0]['recordings'], "original_filename")
+                    self.download_videos(all_recordings[0], PRIORITY_BACKFILL)
+
+            merged_originals = self.wait_for_merges()
+            if self.requests_finished(requested_sequences):
+                # Motion detection resumes after the requests it found once they are finished
+                self.state.commit()
+            else:
+                logger.warning("Not all requested recordings were downloaded and merged, the next pass will look for them again")
+            self.retention.run(merged_originals)
+
+        # except Exception as e:
+        #     logger.error("Error encountered in the belt and braces exception handler: {}".format(e))
+        return True
+
+    def requests_finished(self, requested_sequences):
+        """Return whether the recordings of each request were downloaded, and merged if merging."""
+        for request in requested_sequences:
+            if any(item.get('download_status') != 'complete' for item in request['recordings']):
+                return False
+            if self.config.get('merge_videos') and not request.get('merge_status'):
+                return False
+        return True
+
+    def count_backlog(self, list):
+        """Add the files in list that failed to download to the backlog for this cycle."""
+        self.backlog += sum(1 for item in list if item.get('download_status') == 'failed')
 
     def download_events(self):
-        event_list = self.camera.list_events()
+        with registry.stage("listing"):
+            event_list = self.camera.list_events()
         if event_list and len(event_list) > 0:
             self.camera.prepare_events(event_list)
             total = len(event_list)
             logger.info("{} event{} on device".format(total, plural(total), len(event_list)))
             self.prepare_recordings(event_list)
             self.add_paths(event_list, "event_filename")
-            self.camera.download_files(event_list, "filename", "event_filename")
+            with registry.stage("events"):
+                self.camera.download_files(event_list, "filename", "event_filename", PRIORITY_EVENT)
+            self.state.record_downloads(event_list, "event_filename", "event", protected=True)
+            self.count_backlog(event_list)
 
     def identify_recordings(self):
-        all_recordings = self.camera.list_recordings()
+        with registry.stage("listing"):
+            all_recordings = self.camera.list_recordings()
+        filtered_recordings = []
+        requested_sequences = []
 
         if all_recordings and len(all_recordings) > 0:
-            self.camera.prepare_recordings(all_recordings)
+            all_recordings = self.camera.prepare_recordings(all_recordings)
             filtered_recordings = self.filter_processed(all_recordings)
             total = len(filtered_recordings)
             self.prepare_recordings(filtered_recordings)
+            registry.set("dado_backlog_recordings", len(filtered_recordings))
             logger.info("{} file{} on device of which {} are to be processed".format(total, plural(total), len(filtered_recordings)))
 
             if len(filtered_recordings) > 0:
                 logger.info("The oldest recording on the device is: {}".format(filtered_recordings[0]['start_timestamp']))
-            requested_sequences = []
 
             if self.config.get('process_manual_requests'):
                 logger.info("Processing manual requests..")
 
-                manual_requests = self.find_manual_requests()
+                with registry.stage("manual_requests"):
+                    manual_requests = self.find_manual_requests()
                 requested_sequences.extend(manual_requests)
 
             if self.config.get('process_motion_detection'):
                 logger.info("Processing motion detection..")
 
                 self.add_paths(filtered_recordings, "thumbnail_filename")
-                download_list = self.camera.download_files(filtered_recordings, "thumbnail", "thumbnail_filename")
-                self.motion.calculate_differences(download_list, "thumbnail_filename")
-                requested_sequences.extend(self.motion.identify_requests(download_list))
-
-            self.match_recordings(requested_sequences, all_recordings)
+                if self.config['motion_detection'].get('sample_interval', 1) > 1:
+                    download_list = self.motion.sample_thumbnails(filtered_recordings, "thumbnail_filename", self.download_thumbnails)
+                else:
+                    download_list = self.download_thumbnails(filtered_recordings)
+                with registry.stage("motion"):
+                    self.motion.calculate_differences(download_list, "thumbnail_filename")
+                    requested_sequences.extend(self.motion.identify_requests(download_list))
+
+            self.match_recordings(requested_sequences, IntervalIndex(all_recordings))
             self.remove_empty_requests(requested_sequences)
 
         return (filtered_recordings, requested_sequences)
 
+    def download_thumbnails(self, list):
+        with registry.stage("thumbnails"):
+            download_list = self.camera.download_files(list, "thumbnail", "thumbnail_filename", PRIORITY_THUMBNAIL)
+        self.state.record_downloads(download_list, "thumbnail_filename", "thumbnail")
+        self.count_backlog(download_list)
+        return download_list
+
     def download_recordings(self, requested_sequences):
         downloaded_requests = []
         for requested_sequence in requested_sequences:
@@ -124,49 +283,113 @@ class Dado:
             downloaded_requests.append(self.download_videos(requested_sequence))
 
             if self.config.get('merge_videos'):
-                self.merge_recordings(requested_sequence)
+                # Merged in the background while the next sequence downloads
+                self.merges.append(self.merger.submit(self.merge_and_finish, requested_sequence))
+            else:
+                self.remove_successful_request(requested_sequence)
+
+    def merge_slot(self):
+        """Return a context holding a merge slot shared with the other cameras, if any."""
+        return self.shared.merges.slot(self.name) if self.shared is not None else nullcontext()
+
+    def merge_and_finish(self, request):
+        with self.merge_slot():
+            started = time.perf_counter()
+            try:
+                with registry.stage("merge"):
+                    self.merge_recordings(request)
+            finally:
+                duration = time.perf_counter() - started
+                registry.inc("dado_merges_total", status="success" if request.get('merge_status') else "failed")
+                registry.inc("dado_merge_seconds_total", duration)
+                registry.set("dado_last_merge_seconds", duration)
+        if request['merge_status']:
+            request['merged_sources'] = self.verified_sources(request['recording_filename'] + self.config['recording_extension'])
+            self.remove_successful_request(request)
+        return request
 
-            self.remove_successful_request(requested_sequence)
+    def wait_for_merges(self):
+        """Wait for the merges started this cycle to finish, returning the originals of those that were verified."""
+        if self.merges:
+            logger.debug("Waiting for {} merge{} to finish".format(len(self.merges), plural(len(self.merges))))
+        merged = set()
+        unmerged = set()
+        errors = False
+        for future in self.merges:
+            try:
+                request = future.result()
+            except Exception as e:
+                logger.error("Error merging recordings: {}".format(e))
+                errors = True
+                continue
+            verified = set(request.get('merged_sources') or [])
+            for item in request['recordings']:
+                if os.path.abspath(item['original_filename']) in verified:
+                    merged.add(item['original_filename'])
+                else:
+                    unmerged.add(item['original_filename'])
+        self.merges = []
+        if errors:
+            # The originals of the merge that failed are not known
+            return []
+        # An original may also be part of a merge that failed
+        return sorted(merged - unmerged)
 
     def remove_empty_requests(self, requested_recordings):
         requested_recordings[:] = [tup for tup in requested_recordings if not len(tup['recordings']) == 0]
 
     def prepare_recordings(self, list):
-        for item in list:
-            self.add_local_metadata(item)
+        with registry.stage("metadata"):
+            if isinstance(list, RecordingCatalog):
+                # Worked out by the catalog for the recordings that need them
+                list.set_formats(self.local_formats())
+                return
+            for item in list:
+                self.add_local_metadata(item)
+
+    def local_formats(self):
+        return {'start_timestamp': ('startdatetime', self.config['recording_timestamp']),
+                'end_timestamp': ('enddatetime', self.config['recording_timestamp']),
+                'start_time': ('startdatetime', self.config['recording_time']),
+                'end_time': ('enddatetime', self.config['recording_time']),
+                'directory_timestamp': ('startdatetime', self.config['directory_timestamp'])}
 
     def add_local_metadata(self, item):
-        item['start_timestamp'] = item['startdatetime'].strftime(self.config['recording_timestamp'])
-        item['end_timestamp'] = item['enddatetime'].strftime(self.config['recording_timestamp'])
-        item['start_time'] = item['startdatetime'].strftime(self.config['recording_time'])
-        item['end_time'] = item['enddatetime'].strftime(self.config['recording_time'])
-        item['directory_timestamp'] = item['startdatetime'].strftime(self.config['directory_timestamp'])
+        if 'start_timestamp' in item:
+            # Already added, e.g. to a recording carried over from the previous listing
+            return
+        for (key, (source, format)) in self.local_formats().items():
+            item[key] = timestamp_format(format)(item[source])
 
     def add_paths(self, list, key):
         for item in list:
             self.add_path(item, key)
 
     def add_path(self, item, key):
-        item[key] = os.path.join(self.config['output_root'], self.config[key].format(**item))
+        if key in item:
+            return
+        if key not in self.templates:
+            self.templates[key] = PathTemplate(self.config[key])
+        item[key] = os.path.join(self.config['output_root'], self.templates[key].render(item))
 
     def already_processed(self, item):
         return item['startdatetime'] <= self.state['last_image_processed']['enddatetime']
 
     def filter_processed(self, list):
+        if isinstance(list, RecordingCatalog):
+            if 'last_image_processed' not in self.state:
+                return list
+            return list.starting_after(self.state['last_image_processed']['enddatetime'])
         filtered = []
         for item in list:
             if 'last_image_processed' not in self.state or not self.already_processed(item):
                 filtered.append(item)
         return filtered
 
-    def match_recordings(self, requested_times, list):
+    def match_recordings(self, requested_times, index):
         for requested_time in requested_times:
-            matching_recordings = []
-            for recording in list:
-                if recording['enddatetime'] >= requested_time['startdatetime'] \
-                   and recording['startdatetime'] <= requested_time['enddatetime']:
-                    self.add_local_metadata(recording)
-                    matching_recordings.append(recording)
+            matching_recordings = index.overlapping(requested_time['startdatetime'], requested_time['enddatetime'])
+            self.prepare_recordings(matching_recordings)
 
             if len(matching_recordings) > 0:
                 if "start" not in requested_time:
@@ -180,8 +403,11 @@ class Dado:
                 logger.info("No recordings found matching manual request")
             requested_time['recordings'] = matching_recordings
 
-    def download_videos(self, request):
-        request['downloaded'] = self.camera.download_files(request['recordings'], "name", "original_filename")
+    def download_videos(self, request, priority=PRIORITY_ORIGINAL):
+        with registry.stage("download"):
+            request['downloaded'] = self.camera.download_files(request['recordings'], "name", "original_filename", priority)
+        self.state.record_downloads(request['downloaded'], "original_filename", "original", protected=request.get('event') == 'manual')
+        self.count_backlog(request['downloaded'])
         logger.debug("Downloaded {} recordings".format(len(request['downloaded'])))
 
         return request
@@ -193,29 +419,153 @@ class Dado:
 
         list_file = request['recording_filename'] + self.config['list_extension']
         final_file = request['recording_filename'] + self.config['recording_extension']
-        logger.info("Merging recordings for {}".format(final_file))
 
         path = os.path.dirname(list_file)
         if not os.path.exists(path):
             logger.debug("Making dir {}".format(path))
-            os.makedirs(path)
+            os.makedirs(path, exist_ok=True)
+
+        sources = self.merge_sources(recordings)
+        manifest = self.read_manifest(final_file)
+        if manifest and manifest['sources'] == sources and self.manifest_output_matches(manifest):
+            logger.info("Recordings for {} are unchanged since they were merged".format(final_file))
+            request['merge_status'] = True
+            return
+
+        previous = self.find_extendable_merge(path, sources)
+        if previous:
+            # Only trailing recordings are new, so append them to the earlier merge
+            logger.info("Extending {} with {} recording{} for {}".format(previous['output'], len(sources) - len(previous['sources']),
+                                                                       plural(len(sources) - len(previous['sources'])), final_file))
+            inputs = [previous['output']] + [source['path'] for source in sources[len(previous['sources']):]]
+            output_file = request['recording_filename'] + ".partial" + self.config['recording_extension']
+        else:
+            logger.info("Merging recordings for {}".format(final_file))
+            inputs = [source['path'] for source in sources]
+            output_file = final_file
+            if os.path.isfile(final_file):
+                os.remove(final_file)
 
         with open(list_file, 'w') as f:
-            for recording in recordings:
-                fullpath = os.path.abspath(recording['original_filename'])
+            for fullpath in inputs:
                 f.write("file '{}'\n".format(fullpath))
 
-        if os.path.isfile(final_file):
-            os.remove(final_file)
         try:
-            ffmpeg.input(list_file, format='concat', safe=0).output(final_file, c='copy') \
+            ffmpeg.input(list_file, format='concat', safe=0).output(output_file, c='copy') \
                 .global_args('-loglevel', self.config.get('ffmpeg_log_level', 'info')) \
                 .global_args('-y').run()
             os.remove(list_file)
+            if output_file != final_file:
+                os.replace(output_file, final_file)
+            trimmed = None
+            if self.trimmer and request['event'] == 'motion':
+                trimmed = self.trimmer.trim(final_file, [source['path'] for source in sources])
+            self.write_manifest(final_file, sources, request['event'], trimmed)
+            self.state.record_file(final_file, "recording", os.stat(final_file).st_size, request['startdatetime'].timestamp(),
+                                   protected=request['event'] == 'manual')
             request['merge_status'] = True
+            if previous:
+                self.remove_superseded(previous, final_file, request)
         except Exception as e:
             logger.error("Error merging recordings with ffmpeg: {}".format(e))
             request['merge_status'] = False
+        self.state.record_merge(final_file, request['merge_status'], len(recordings))
+
+    def merge_sources(self, recordings):
+        sources = []
+        for recording in recordings:
+            fullpath = os.path.abspath(recording['original_filename'])
+            try:
+                stat = os.stat(fullpath)
+                sources.append({"path": fullpath, "size": stat.st_size, "mtime": stat.st_mtime_ns})
+            except OSError:
+                sources.append({"path": fullpath, "size": None, "mtime": None})
+        return sources
+
+    def manifest_file(self, final_file):
+        return final_file + self.config.get('manifest_extension', '.manifest')
+
+    def read_manifest(self, final_file):
+        try:
+            with open(self.manifest_file(final_file), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write_manifest(self, final_file, sources, event, trimmed=None):
+        """Record the recordings a merged file was made from, and the part of them kept if it was trimmed, alongside it."""
+        stat = os.stat(final_file)
+        manifest = {"output": os.path.abspath(final_file),
+                    "size": stat.st_size,
+                    "mtime": stat.st_mtime_ns,
+                    "event": event,
+                    "sources": sources}
+        if trimmed:
+            manifest['trimmed'] = trimmed
+        manifest_file = self.manifest_file(final_file)
+        with open(manifest_file + ".tmp", 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(manifest_file + ".tmp", manifest_file)
+
+    def verified_sources(self, final_file):
+        """Return the recordings a merge was made from if the merged file and they are as its manifest records, else None."""
+        manifest = self.read_manifest(final_file)
+        if not manifest or not self.manifest_output_matches(manifest) or manifest['size'] == 0:
+            return None
+        if self.merge_sources([{"original_filename": source['path']} for source in manifest['sources']]) != manifest['sources']:
+            return None
+        return [source['path'] for source in manifest['sources']]
+
+    def manifest_output_matches(self, manifest):
+        try:
+            stat = os.stat(manifest['output'])
+        except OSError:
+            return False
+        return stat.st_size == manifest['size'] and stat.st_mtime_ns == manifest['mtime']
+
+    def find_extendable_merge(self, directory, sources):
+        """Find the manifest of an earlier merge whose recordings are the first of sources.
+
+        Returns the manifest with the most recordings in common, or None.
+        Trimmed merges are not extended as they no longer end with their
+        last recording.
+        """
+        if any(source['size'] is None for source in sources):
+            return None
+        extension = self.config.get('manifest_extension', '.manifest')
+        best = None
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not entry.name.endswith(extension):
+                    continue
+                manifest = self.read_manifest(entry.path[:-len(extension)])
+                if not manifest or manifest.get('trimmed'):
+                    continue
+                count = len(manifest['sources'])
+                if 0 < count < len(sources) and manifest['sources'] == sources[:count] \
+                   and (best is None or count > len(best['sources'])) and self.manifest_output_matches(manifest):
+                    best = manifest
+        return best
+
+    def remove_superseded(self, previous, final_file, request):
+        """Remove an earlier merge that final_file was extended from, once it holds all of its recordings.
+
+        Only merges made for the same kind of request are removed, so the
+        merge of a manual request is kept when a motion request extends it.
+        """
+        if previous['output'] == os.path.abspath(final_file) or previous.get('event') != request['event']:
+            return
+        logger.info("Removing {}, superseded by {}".format(previous['output'], final_file))
+        for path in (previous['output'], self.manifest_file(previous['output'])):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error("Error removing {}: {}".format(path, e))
+                return
+        # The earlier merge is in the same directory, and indexed by its path as final_file is
+        self.state.forget_files([os.path.join(os.path.dirname(final_file), os.path.basename(previous['output']))])
 
     def remove_successful_request(self, item):
         if item['event'] == 'manual':
@@ -232,9 +582,25 @@ class Dado:
                     list.append({"dir": dirpath, "filename": name})
         return list
 
+    def scan_path(self, directory, extension):
+        logger.debug("Scan path: {} to find files with extension {}".format(directory, extension))
+        list = []
+        extension = extension.lower()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.lower().endswith(extension) and entry.is_file():
+                    list.append({"dir": directory, "filename": entry.name})
+        return list
+
+    def manual_request_path(self):
+        return os.path.join(self.config['output_root'], self.config['manual_request_dir'])
+
     def find_manual_requests(self):
         requests = []
-        list = self.iterate_path(self.config['output_root'], self.config['manual_request_extension'])
+        if self.config.get('manual_request_dir'):
+            list = self.scan_path(self.manual_request_path(), self.config['manual_request_extension'])
+        else:
+            list = self.iterate_path(self.config['output_root'], self.config['manual_request_extension'])
         # Data comes back as:
         #    [{'dir': 'cctv/dashcam', 'filename': '2020-05-14-1200-1210.request'}]
         for item in list:
@@ -259,7 +625,22 @@ class Dado:
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--config", help="Specify the relative path to the config file, defaults to config.yaml", default="config.yaml")
+    parser.add_argument("--profile-cycle", type=int, nargs="?", const=1, metavar="N",
+                        help="Run N cycles (default 1) under the profiler, report where the time went and exit")
+    parser.add_argument("--profile-output", default="dado.prof",
+                        help="File to write the profile to, defaults to dado.prof")
+    parser.add_argument("--profile-top", type=int, default=25, help="Number of functions to list in the profile report")
     args = parser.parse_args()
 
-    dado = Dado(args.config)
-    dado.run_daemon()
+    config = load_config(args.config)
+    configure_logging(config)
+    if config.get('cameras'):
+        if args.profile_cycle:
+            parser.error("--profile-cycle runs a single camera, not a cameras list")
+        Fleet(config, Dado).run()
+    else:
+        dado = Dado(config)
+        if args.profile_cycle:
+            dado.run_profiled(args.profile_cycle, args.profile_output, args.profile_top)
+        else:
+            dado.run_daemon()
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+import io
+import os.path
+import os
+import json
+import random
+import re
+import shutil
+import subprocess
+import argparse
+import logging
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+NAME_FORMAT = "%Y%m%d%H%M%S"
+
+
+class FakeCamera:
+    """A local stand in for a DDPAI camera, used for testing and benchmarks.
+
+    Serves the API calls used by Dado along with synthetic thumbnails and
+    videos for a listing of recordings ending now. Periods of movement are
+    spread through the listing so motion detection has something to find.
+    Responses can be delayed, throttled to a bandwidth and made to fail.
+    """
+
+    def __init__(self, recordings=1440, segment_seconds=60, events=5, motion_fraction=0.1, motion_length=15,
+                 video_size=2097152, thumbnail_size=(320, 180), bandwidth=None, latency=0.0, failure_rate=0.0,
+                 api_path="vcam/cmd.cgi?cmd=", seed=0, end=None):
+        self.segment_seconds = segment_seconds
+        self.video_size = video_size
+        self.thumbnail_size = thumbnail_size
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.api_path = urlparse("/" + api_path).path
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.thumbnails = {}
+        self.requests = 0
+        self.bytes_sent = 0
+
+        # The camera reports times advanced by the UTC offset, see DDPAI.add_datetime_from_timestamp()
+        self.utcoffset = datetime.now(timezone.utc).astimezone().utcoffset() // timedelta(seconds=1)
+        end = int(end or time.time()) // segment_seconds * segment_seconds
+        start = end - recordings * segment_seconds
+
+        moving = set()
+        while len(moving) < recordings * motion_fraction:
+            first = self.random.randrange(recordings)
+            moving.update(range(first, min(recordings, first + motion_length)))
+        self.recordings = []
+        for index in range(recordings):
+            starttime = start + index * segment_seconds
+            name = "{}_{:04d}.mp4".format(datetime.fromtimestamp(starttime).strftime(NAME_FORMAT), segment_seconds)
+            self.recordings.append({"index": index,
+                                    "type": 0,
+                                    "starttime": str(starttime + self.utcoffset),
+                                    "endtime": str(starttime + segment_seconds + self.utcoffset),
+                                    "name": name,
+                                    "moving": index in moving})
+        self.by_thumbnail = {recording['name'].replace(".mp4", "_T.jpg"): recording for recording in self.recordings}
+
+        self.events = []
+        for recording in self.random.sample(self.recordings, min(events, len(self.recordings))):
+            self.events.append({"bvideoname": recording['name'].replace(".mp4", "_E.mp4"),
+                                "bstarttime": recording['starttime'],
+                                "bendtime": recording['endtime'],
+                                "imgname": ""})
+
+        self.base = np.random.default_rng(seed).integers(0, 256, (thumbnail_size[1], thumbnail_size[0], 3), dtype=np.uint8)
+        self.idle_thumbnail = self.encode(self.base)
+        self.video = self.make_video()
+
+    def encode(self, pixels):
+        output = io.BytesIO()
+        Image.fromarray(pixels).save(output, format="JPEG", quality=85)
+        return output.getvalue()
+
+    def thumbnail(self, recording):
+        if not recording['moving']:
+            return self.idle_thumbnail
+        with self.lock:
+            if recording['name'] not in self.thumbnails:
+                rng = np.random.default_rng(recording['index'])
+                shift = int(rng.integers(8, 64))
+                pixels = np.roll(self.base, shift, axis=1) // 2 + rng.integers(0, 128, self.base.shape, dtype=np.uint8)
+                self.thumbnails[recording['name']] = self.encode(pixels)
+            return self.thumbnails[recording['name']]
+
+    def make_video(self):
+        """Generate a video of about video_size bytes, using ffmpeg if it is available."""
+        if shutil.which("ffmpeg"):
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, "segment.mp4")
+                bitrate = max(16000, self.video_size * 8 // self.segment_seconds)
+                result = subprocess.run(["ffmpeg", "-loglevel", "error", "-f", "lavfi",
+                                         "-i", "testsrc=duration={}:size=320x180:rate=10".format(self.segment_seconds),
+                                         "-c:v", "mpeg4", "-b:v", str(bitrate), "-y", path])
+                if result.returncode == 0:
+                    with open(path, "rb") as f:
+                        return f.read()
+        logger.info("ffmpeg not available, serving random data as video")
+        return os.urandom(self.video_size)
+
+    def content(self, name):
+        if name in self.by_thumbnail:
+            return self.thumbnail(self.by_thumbnail[name])
+        if name.endswith(".mp4"):
+            return self.video
+        return None
+
+    def api(self, command):
+        if command == "API_RequestSessionID":
+            return {"acSessionId": "fakecamera"}
+        elif command in ("API_RequestCertificate", "API_SyncDate"):
+            return {}
+        elif command == "APP_PlaybackListReq":
+            return {"num": len(self.recordings),
+                    "file": [{key: value for (key, value) in recording.items() if key != "moving"} for recording in self.recordings]}
+        elif command == "APP_EventListReq":
+            return {"num": len(self.events), "event": self.events}
+        return None
+
+    def fail(self):
+        return self.failure_rate > 0 and self.random.random() < self.failure_rate
+
+    def handler(self):
+        camera = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                if length:
+                    self.rfile.read(length)
+                self.do_GET()
+
+            def do_GET(self):
+                with camera.lock:
+                    camera.requests += 1
+                if camera.latency:
+                    time.sleep(camera.latency)
+                url = urlparse(self.path)
+                if url.path == camera.api_path:
+                    command = url.query.split("=", 1)[-1] if "=" in url.query else parse_qs(url.query).get('cmd', [""])[0]
+                    data = camera.api(command)
+                    if data is None:
+                        return self.send_error(404)
+                    return self.send_body(200, json.dumps({"errcode": 0, "data": json.dumps(data)}).encode(), "application/json")
+
+                content = camera.content(url.path.lstrip("/"))
+                if content is None:
+                    return self.send_error(404)
+                if camera.fail():
+                    return self.send_error(503)
+                self.send_range(content)
+
+            def send_range(self, content):
+                match = re.match(r"bytes=(\d+)-", self.headers.get('Range', ''))
+                if match:
+                    start = int(match.group(1))
+                    if start >= len(content):
+                        self.send_response(416)
+                        self.send_header("Content-Range", "bytes */{}".format(len(content)))
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    self.send_body(206, content[start:], "application/octet-stream",
+                                   {"Content-Range": "bytes {}-{}/{}".format(start, len(content) - 1, len(content))})
+                else:
+                    self.send_body(200, content, "application/octet-stream")
+
+            def send_body(self, status, body, content_type, headers={}):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for (key, value) in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+
+                # Drop the connection part way through to simulate the link failing
+                cutoff = len(body) // 2 if len(body) > 65536 and camera.fail() else None
+                chunk_size = 65536
+                started = time.monotonic()
+                sent = 0
+                while sent < len(body):
+                    if cutoff is not None and sent >= cutoff:
+                        self.close_connection = True
+                        return
+                    chunk = body[sent:sent + chunk_size]
+                    if camera.bandwidth:
+                        delay = (sent + len(chunk)) / camera.bandwidth - (time.monotonic() - started)
+                        if delay > 0:
+                            time.sleep(delay)
+                    self.wfile.write(chunk)
+                    sent += len(chunk)
+                    with camera.lock:
+                        camera.bytes_sent += len(chunk)
+
+        return Handler
+
+    def serve(self, address="127.0.0.1", port=0):
+        """Start serving on a background thread, returning the port in use."""
+        self.server = ThreadingHTTPServer((address, port), self.handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="fakecamera", daemon=True).start()
+        logger.info("Fake camera serving {} recordings on {}:{}".format(len(self.recordings), address, self.server.server_port))
+        return self.server.server_port
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def add_arguments(parser):
+    parser.add_argument("--recordings", type=int, default=1440, help="Number of recordings on the fake camera")
+    parser.add_argument("--segment-seconds", type=int, default=60, help="Length of each recording")
+    parser.add_argument("--events", type=int, default=5, help="Number of events on the fake camera")
+    parser.add_argument("--motion-fraction", type=float, default=0.1, help="Fraction of recordings with movement")
+    parser.add_argument("--video-size", type=int, default=2097152, help="Approximate size of each video in bytes")
+    parser.add_argument("--bandwidth", type=float, default=None, help="Limit each response to this many bytes per second")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds to wait before each response")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of downloads that fail")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the generated content")
+    parser.add_argument("--end", type=int, default=None, help="Time the listing ends as seconds since the epoch, defaults to now")
+
+
+def from_arguments(args):
+    return FakeCamera(recordings=args.recordings, segment_seconds=args.segment_seconds, events=args.events,
+                      motion_fraction=args.motion_fraction, video_size=args.video_size, bandwidth=args.bandwidth,
+                      latency=args.latency, failure_rate=args.failure_rate, seed=args.seed, end=args.end)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a fake DDPAI camera")
+    parser.add_argument("--address", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
+    camera = from_arguments(args)
+    camera.serve(args.address, args.port)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        camera.shutdown()
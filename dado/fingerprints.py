@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import os.path
+import os
+import logging
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fingerprints (path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime INTEGER NOT NULL,
+                                         downscale INTEGER NOT NULL, height INTEGER NOT NULL, width INTEGER NOT NULL,
+                                         data BLOB NOT NULL, used REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS fingerprints_used ON fingerprints (used);
+CREATE TABLE IF NOT EXISTS totals (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+"""
+
+
+class FingerprintCache:
+    """An on-disk cache of the small grayscale frames used to compare thumbnails.
+
+    Frames are keyed by the path of the image and are only returned while
+    the size and modification time of the file are unchanged, so a
+    thumbnail that has been seen before does not need to be decoded again.
+    The least recently used frames are evicted once the cache grows past
+    max_bytes of frame data. The cache can be shared by the processes of
+    a motion pool, so the total size of the frames is kept in the database
+    and updated in the transaction that changes them.
+    """
+
+    def __init__(self, path, max_bytes):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            logger.debug("Making dir {}".format(directory))
+            os.makedirs(directory, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+            # A cache written before the total was kept is measured once
+            self.connection.execute("INSERT OR IGNORE INTO totals (name, value) "
+                                    "SELECT 'size', COALESCE(SUM(LENGTH(data)), 0) FROM fingerprints")
+        self.touched = {}
+
+    def get(self, path, downscale):
+        """Return the cached frame for an image, or None if it is missing or stale."""
+        stat = os.stat(path)
+        with self.lock:
+            row = self.connection.execute("SELECT size, mtime, downscale, height, width, data FROM fingerprints WHERE path = ?",
+                                          (path,)).fetchone()
+            if row is None or row[:3] != (stat.st_size, stat.st_mtime_ns, downscale):
+                return None
+            self.touched[path] = time.time()
+        return np.frombuffer(row[5], dtype=np.uint8).reshape(row[3], row[4])
+
+    def put(self, path, downscale, frame):
+        stat = os.stat(path)
+        data = np.ascontiguousarray(frame, dtype=np.uint8).tobytes()
+        with self.lock, self.connection:
+            previous = self.connection.execute("SELECT LENGTH(data) FROM fingerprints WHERE path = ?", (path,)).fetchone()
+            self.connection.execute("INSERT OR REPLACE INTO fingerprints (path, size, mtime, downscale, height, width, data, used) "
+                                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                    (path, stat.st_size, stat.st_mtime_ns, downscale, frame.shape[0], frame.shape[1], data, time.time()))
+            self.connection.execute("UPDATE totals SET value = value + ? WHERE name = 'size'",
+                                    (len(data) - (previous[0] if previous else 0),))
+            size = self.total_size()
+        if size > self.max_bytes:
+            self.evict()
+
+    def total_size(self):
+        return self.connection.execute("SELECT value FROM totals WHERE name = 'size'").fetchone()[0]
+
+    def flush(self):
+        """Write the last use of frames returned by get, which decides the order of eviction."""
+        with self.lock, self.connection:
+            self.connection.executemany("UPDATE fingerprints SET used = ? WHERE path = ?",
+                                        [(used, path) for (path, used) in self.touched.items()])
+            self.touched = {}
+
+    def evict(self):
+        """Remove the least recently used frames until the cache is below 90% of its limit."""
+        self.flush()
+        removed = 0
+        with self.lock, self.connection:
+            # Take the write lock before reading the total, so processes evicting together do not remove too much
+            self.connection.execute("BEGIN IMMEDIATE")
+            size = self.total_size()
+            cursor = self.connection.execute("SELECT path, LENGTH(data) FROM fingerprints ORDER BY used")
+            evicted = []
+            for (path, length) in cursor:
+                if size <= self.max_bytes * 0.9:
+                    break
+                evicted.append((path,))
+                size -= length
+                removed += 1
+            self.connection.executemany("DELETE FROM fingerprints WHERE path = ?", evicted)
+            self.connection.execute("UPDATE totals SET value = ? WHERE name = 'size'", (size,))
+        logger.debug("Evicted {} fingerprints from the cache".format(removed))
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+import copy
+import itertools
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+from metrics import registry, MetricsServer
+
+logger = logging.getLogger(__name__)
+
+
+class FairBudget:
+    """A number of slots shared between owners, e.g. the downloads of several cameras.
+
+    When a slot is free it goes to the waiting owner holding the fewest
+    slots, the longest waiting first between owners holding as many, so
+    an owner with a large backlog cannot keep the others waiting.
+    """
+
+    def __init__(self, slots):
+        self.slots = max(1, int(slots))
+        self.condition = threading.Condition()
+        self.active = {}
+        self.waiting = []
+        self.sequence = itertools.count()
+
+    def next_waiting(self):
+        return min(self.waiting, key=lambda ticket: (self.active.get(ticket[0], 0), ticket[1]))
+
+    def acquire(self, owner):
+        with self.condition:
+            ticket = (owner, next(self.sequence))
+            self.waiting.append(ticket)
+            while sum(self.active.values()) >= self.slots or self.next_waiting() != ticket:
+                self.condition.wait()
+            self.waiting.remove(ticket)
+            self.active[owner] = self.active.get(owner, 0) + 1
+            # Another slot may also be free for the next in line
+            self.condition.notify_all()
+
+    def release(self, owner):
+        with self.condition:
+            self.active[owner] -= 1
+            self.condition.notify_all()
+
+    @contextmanager
+    def slot(self, owner):
+        self.acquire(owner)
+        try:
+            yield
+        finally:
+            self.release(owner)
+
+
+class SharedWorkers:
+    """The download, merge and motion detection workers shared by the cameras of a Fleet."""
+
+    def __init__(self, config):
+        self.downloads = FairBudget(config.get('download_workers', 4))
+        self.merges = FairBudget(config.get('merge_workers', 1))
+        self.decodes = FairBudget(config.get('motion_workers', 2))
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def motion_pool(self):
+        """Return the pool of processes used by the cameras for motion detection, started on first use."""
+        with self.lock:
+            if self.executor is None:
+                logger.debug("Starting {} shared motion detection worker processes".format(self.decodes.slots))
+                self.executor = ProcessPoolExecutor(max_workers=self.decodes.slots, mp_context=multiprocessing.get_context('spawn'))
+            return self.executor
+
+
+def merge_config(base, overrides):
+    """Return base with the values in overrides, merging the sections found in both."""
+    merged = copy.deepcopy(base)
+    for (key, value) in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_config(merged[key], value)
+        else:
+            merged[key] = copy.deepcopy(value)
+    return merged
+
+
+def camera_configs(config):
+    """Return the configuration of each camera in the cameras list, laid over the rest of config."""
+    base = {key: value for (key, value) in config.items() if key not in ('cameras', 'fleet')}
+    configs = []
+    for (index, entry) in enumerate(config['cameras']):
+        camera_config = merge_config(base, entry)
+        camera_config['name'] = str(entry.get('name', "camera{}".format(index + 1)))
+        for other in configs:
+            if other['name'] == camera_config['name']:
+                raise ValueError("More than one camera is named {}".format(camera_config['name']))
+            if other['output_root'] == camera_config['output_root']:
+                raise ValueError("Cameras {} and {} have the same output_root".format(other['name'], camera_config['name']))
+        configs.append(camera_config)
+    return configs
+
+
+class Fleet:
+    """Runs several cameras in one process.
+
+    Each entry in the cameras list is laid over the rest of the
+    configuration, so any option can be set per camera. Entries need at
+    least a name, their own output_root and a camera section with the
+    address. Each camera runs passes on its own thread with its own state,
+    polling and motion detection settings, while downloads, merges and
+    motion detection processes come from budgets in the fleet section that
+    are shared fairly between them.
+    """
+
+    def __init__(self, config, camera_class):
+        self.config = config
+        self.shared = SharedWorkers(config.get('fleet') or {})
+        metrics_config = config.get('metrics') or {}
+        if metrics_config.get('port'):
+            MetricsServer(registry, metrics_config.get('address', '127.0.0.1'), metrics_config['port']).start()
+        self.cameras = [camera_class(camera_config, self.shared) for camera_config in camera_configs(config)]
+        logger.info("Running {} cameras: {}".format(len(self.cameras), ", ".join(camera.name for camera in self.cameras)))
+
+    def run(self):
+        threads = [threading.Thread(target=self.run_camera, args=(camera,), name=camera.name, daemon=True) for camera in self.cameras]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def run_camera(self, camera):
+        registry.bind(camera=camera.name)
+        while True:
+            try:
+                camera.run_daemon()
+            except Exception:
+                interval = camera.config.get('sleep_interval', 600)
+                logger.exception("Error running camera {}, restarting in {} seconds".format(camera.name, interval))
+                time.sleep(interval)
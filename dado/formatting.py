@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import re
+from datetime import datetime
+from string import Formatter
+
+# Directives that depend only on the date, and those that also depend on the hour and minute
+DATE_DIRECTIVES = set("aAbBCdDeFgGjmuUVwWxyY%")
+MINUTE_DIRECTIVES = DATE_DIRECTIVES | set("HIMRp")
+
+# Entries kept for each format before its memo is cleared
+CACHE_SIZE = 65536
+
+# The attribute and index parts of a field name, e.g. .year and [start_timestamp]
+FIELD_PART = re.compile(r"\.([^.[]+)|\[([^\]]+)\]")
+
+
+class TimestampFormat:
+    """Formats datetimes as strftime does with one format, remembering the results.
+
+    Results are kept for each day when the format only has directives for
+    the date, or each minute when it also has the hour and minute, so the
+    timestamps of recordings listed every pass are formatted once. Formats
+    with other directives, e.g. seconds, are passed to strftime each time.
+    from_timestamp() also remembers the result for each epoch time, for
+    callers that have not made a datetime yet.
+    """
+
+    def __init__(self, format):
+        self.format = format
+        # Literal text at even positions, directives at odd positions
+        tokens = re.split("(%.)", format)
+        directives = set(token[1] for token in tokens[1::2])
+        if any("%" in literal for literal in tokens[0::2]):
+            self.bucket = None
+        elif directives <= DATE_DIRECTIVES:
+            self.bucket = "day"
+        elif directives <= MINUTE_DIRECTIVES:
+            self.bucket = "minute"
+        else:
+            self.bucket = None
+        self.results = {}
+        self.timestamps = {}
+
+    def __call__(self, value):
+        if self.bucket is None:
+            return value.strftime(self.format)
+        if self.bucket == "day":
+            key = (value.year, value.month, value.day)
+        else:
+            key = (value.year, value.month, value.day, value.hour, value.minute)
+        result = self.results.get(key)
+        if result is None:
+            if len(self.results) >= CACHE_SIZE:
+                self.results.clear()
+            result = self.results[key] = value.strftime(self.format)
+        return result
+
+    def from_timestamp(self, seconds):
+        """Format the local time of an epoch time given in whole seconds."""
+        result = self.timestamps.get(seconds)
+        if result is None:
+            if len(self.timestamps) >= CACHE_SIZE:
+                self.timestamps.clear()
+            result = self.timestamps[seconds] = self(datetime.fromtimestamp(seconds))
+        return result
+
+
+def split_field_name(field):
+    """Split a field name as str.format does, into the first name and a list of (is attribute, key).
+
+    Raises ValueError if the field name is not one str.format accepts.
+    """
+    first = re.match(r"[^.[]*", field).group()
+    rest = []
+    position = len(first)
+    while position < len(field):
+        match = FIELD_PART.match(field, position)
+        if not match:
+            raise ValueError("Invalid field name {}".format(field))
+        if match.group(1) is not None:
+            rest.append((True, match.group(1)))
+        else:
+            key = match.group(2)
+            rest.append((False, int(key) if key.isdigit() else key))
+        position = match.end()
+    return (first, rest)
+
+
+class PathTemplate:
+    """A str.format template parsed once, rendered with values from a mapping as format_map would.
+
+    Fields may index into values, e.g. {start[start_timestamp]}, and are
+    only looked up when the template names them.
+    """
+
+    def __init__(self, template):
+        self.template = template
+        self.parts = []
+        self.simple = True
+        for (literal, field, spec, conversion) in Formatter().parse(template):
+            if field is None:
+                self.parts.append((literal, None, None, None, None))
+                continue
+            try:
+                (first, rest) = split_field_name(field)
+            except ValueError:
+                first = ""
+            if first == "" or first.isdigit() or (spec and "{" in spec):
+                # Positional, nested or invalid fields are left to format_map to report or work out
+                self.simple = False
+                break
+            self.parts.append((literal, first, rest, spec, conversion))
+
+    def render(self, values):
+        if not self.simple:
+            return self.template.format_map(values)
+        output = []
+        for (literal, first, rest, spec, conversion) in self.parts:
+            output.append(literal)
+            if first is None:
+                continue
+            value = values[first]
+            for (attribute, key) in rest:
+                value = getattr(value, key) if attribute else value[key]
+            if conversion == "r":
+                value = repr(value)
+            elif conversion == "s":
+                value = str(value)
+            elif conversion == "a":
+                value = ascii(value)
+            output.append(value if type(value) is str and not spec else format(value, spec or ""))
+        return "".join(output)
+
+
+formats = {}
+
+
+def timestamp_format(format):
+    """Return the TimestampFormat for a format, shared by all its users."""
+    if format not in formats:
+        formats[format] = TimestampFormat(format)
+    return formats[format]
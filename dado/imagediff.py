@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+import logging
+
+import numpy as np
+from PIL import Image
+from skimage import io
+
+from fingerprints import FingerprintCache
+
+logger = logging.getLogger(__name__)
+
+# The original mean squared error sums the squared difference of all three
+# colour channels for each pixel. A grayscale frame has one channel, so for
+# a change in brightness the grayscale score is a third of the colour score.
+SCORE_SCALE = 3.0
+
+
+def mse(imageA, imageB):
+    """Compare image content to allow a difference number to be used as a trigger."""
+    err = np.sum((imageA.astype("float") - imageB.astype("float")) ** 2)
+    err /= float(imageA.shape[0] * imageA.shape[1])
+    return err
+
+
+def load_frame(path, downscale):
+    """Decode a JPEG as a small grayscale frame.
+
+    The JPEG decoder is asked for a reduced size so the image is scaled in
+    the DCT domain instead of being decoded at full resolution first.
+    """
+    with Image.open(path) as image:
+        (width, height) = image.size
+        image.draft('L', (max(1, width // downscale), max(1, height // downscale)))
+        return np.asarray(image.convert('L'))
+
+
+class LegacyDiffer:
+    """Full resolution colour comparison as originally used for motion detection."""
+
+    def __init__(self, config):
+        self.config = config
+        # Identifies the scores this differ gives, so stored scores are only reused by the same settings
+        self.settings = "legacy"
+
+    def load(self, path):
+        return io.imread(path)
+
+    def difference(self, imageA, imageB):
+        return mse(imageA, imageB)
+
+    def flush(self):
+        pass
+
+
+class FrameDiffer:
+    """Downscaled grayscale comparison.
+
+    Frames are compared as 8 bit grayscale arrays at a fraction of the
+    thumbnail resolution using preallocated float32 buffers. Scores are
+    multiplied by score_scale so that they can be compared with the same
+    sensitivity as the legacy engine. The calibrate option of motion
+    detection measures a value for score_scale from real thumbnails, which
+    is used when score_scale is not set.
+
+    When fingerprint_cache is set, frames are kept in a FingerprintCache so
+    thumbnails that have been compared before are not decoded again.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.downscale = config.get('downscale', 4)
+        self.score_scale = config.get('score_scale') or SCORE_SCALE
+        self.buffer = None
+        self.stack = None
+        self.cache = None
+        if config.get('fingerprint_cache'):
+            self.cache = FingerprintCache(config['fingerprint_cache'], config.get('fingerprint_cache_mb', 64) * 1048576)
+
+    @property
+    def settings(self):
+        return "fast downscale={} score_scale={}".format(self.downscale, float(self.score_scale))
+
+    def load(self, path):
+        if self.cache:
+            frame = self.cache.get(path, self.downscale)
+            if frame is not None:
+                return frame
+        frame = load_frame(path, self.downscale)
+        if self.cache:
+            self.cache.put(path, self.downscale, frame)
+        return frame
+
+    def flush(self):
+        if self.cache:
+            self.cache.flush()
+
+    def allocate(self, name, shape):
+        buffer = getattr(self, name)
+        if buffer is None or buffer.shape[1:] != shape[1:] or buffer.shape[0] < shape[0]:
+            buffer = np.empty(shape, dtype=np.float32)
+            setattr(self, name, buffer)
+        return buffer[:shape[0]]
+
+    def difference(self, frameA, frameB):
+        if frameA.shape != frameB.shape:
+            raise ValueError("Frame sizes differ: {} and {}".format(frameA.shape, frameB.shape))
+        buffer = self.allocate('buffer', (1,) + frameA.shape)[0]
+        np.subtract(frameA, frameB, out=buffer, dtype=np.float32)
+        np.square(buffer, out=buffer)
+        return float(buffer.mean(dtype=np.float64)) * self.score_scale
+
+    def differences(self, frames):
+        """Return the differences between each consecutive pair of frames.
+
+        The frames are copied into a single stack and compared in one
+        operation, returning one score fewer than the number of frames.
+        """
+        if len(frames) < 2:
+            return np.zeros(0)
+        shape = frames[0].shape
+        for frame in frames:
+            if frame.shape != shape:
+                raise ValueError("Frame sizes differ: {} and {}".format(shape, frame.shape))
+        stack = self.allocate('stack', (len(frames),) + shape)
+        for (index, frame) in enumerate(frames):
+            stack[index] = frame
+        diff = self.allocate('buffer', (len(frames) - 1,) + shape)
+        np.subtract(stack[1:], stack[:-1], out=diff)
+        np.square(diff, out=diff)
+        return diff.mean(axis=(1, 2), dtype=np.float64) * self.score_scale
+
+
+def calibrate(paths, differ, samples=100):
+    """Return the score_scale that best matches the legacy engine for a set of images, or None."""
+    legacy = LegacyDiffer(differ.config)
+    ratios = []
+    for (previous, path) in zip(paths, paths[1:]):
+        if len(ratios) >= samples:
+            break
+        try:
+            expected = legacy.difference(legacy.load(previous), legacy.load(path))
+            actual = differ.difference(differ.load(previous), differ.load(path)) / differ.score_scale
+        except (ValueError, OSError) as e:
+            logger.debug("Skipping calibration of {}: {}".format(path, e))
+            continue
+        if expected > 0 and actual > 0:
+            ratios.append(expected / actual)
+    if ratios:
+        logger.info("Calibration over {} image pairs suggests a score_scale of {:.2f} (in use {:.2f})".format(
+            len(ratios), float(np.median(ratios)), differ.score_scale))
+        return round(float(np.median(ratios)), 2)
+    logger.info("Calibration found no changing image pairs to measure")
+    return None
+
+
+DIFFERS = {
+    'legacy': LegacyDiffer,
+    'fast': FrameDiffer,
+}
+
+# Differs created in worker processes, kept to reuse their buffers between chunks
+process_differs = {}
+
+
+def chunk_differences(config, paths):
+    """Load a chunk of images and compare each with the last image loaded before it.
+
+    Runs in a worker process. Returns a (loaded, image_diff, error) tuple for
+    each path. The first image loaded in a chunk has nothing to be compared
+    with, so its image_diff is None and is left for the caller to calculate.
+    """
+    # The pool may be shared by cameras with different settings
+    settings = tuple(sorted((key, str(value)) for (key, value) in config.items()))
+    if settings not in process_differs:
+        process_differs[settings] = DIFFERS[config.get('engine', 'legacy')](config)
+    differ = process_differs[settings]
+
+    results = []
+    last = None
+    for path in paths:
+        try:
+            image = differ.load(path)
+        except (ValueError, OSError) as e:
+            results.append((False, None, str(e)))
+            continue
+        if last is None:
+            results.append((True, None, None))
+        else:
+            try:
+                results.append((True, differ.difference(last, image), None))
+            except ValueError as e:
+                results.append((True, 0, str(e)))
+        last = image
+    differ.flush()
+    return results
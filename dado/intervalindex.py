@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+
+import numpy as np
+
+# Seconds a local time can differ from the epoch time it is compared as, around a change of daylight saving time
+SLACK = 7200
+
+
+class IntervalIndex:
+    """Finds the recordings overlapping a period of time.
+
+    Built once from a listing, the recordings are sorted by start time and
+    the running maximum of their end times is kept alongside, so the
+    recordings that can overlap a period are found with two binary searches.
+    Recordings are returned in order of start time.
+
+    A RecordingCatalog is searched by its epoch columns without making a
+    datetime for each recording. As local times are ambiguous around a
+    change of daylight saving time, the search is widened by SLACK and the
+    recordings found are then checked one by one.
+    """
+
+    def __init__(self, recordings, startkey='startdatetime', endkey='enddatetime'):
+        self.startkey = startkey
+        self.endkey = endkey
+        if hasattr(recordings, 'column'):
+            # The position of each recording in the listing, to keep the order of recordings starting together
+            self.order = np.argsort(recordings.column('start_epoch'), kind='stable')
+            self.recordings = recordings.view(recordings.rows[self.order])
+            self.starts = self.recordings.column('start_epoch') - recordings.utcoffset
+            self.max_ends = np.maximum.accumulate(self.recordings.column('end_epoch') - recordings.utcoffset)
+            self.epochs = True
+        else:
+            self.recordings = sorted(recordings, key=lambda recording: recording[startkey])
+            self.starts = [recording[startkey] for recording in self.recordings]
+            self.max_ends = list(accumulate((recording[endkey] for recording in self.recordings), max))
+            self.epochs = False
+
+    def overlapping(self, start, end):
+        """Return the recordings that end at or after start and start at or before end."""
+        if self.epochs:
+            first = int(np.searchsorted(self.max_ends, start.timestamp() - SLACK, side='left'))
+            last = int(np.searchsorted(self.starts, end.timestamp() + SLACK, side='right'))
+            found = [(recording[self.startkey], position, recording)
+                     for (position, recording) in zip(self.order[first:last].tolist(), self.recordings[first:last])
+                     if recording[self.endkey] >= start and recording[self.startkey] <= end]
+            return [recording for (started, position, recording) in sorted(found, key=lambda entry: entry[:2])]
+        first = bisect_left(self.max_ends, start)
+        last = bisect_right(self.starts, end)
+        return [recording for recording in self.recordings[first:last] if recording[self.endkey] >= start]
+
+    def __len__(self):
+        return len(self.recordings)
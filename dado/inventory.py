@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+import os.path
+import os
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class LocalInventory:
+    """The files in the directories downloads are saved to, read once per pass.
+
+    Each directory is read with a single os.scandir the first time a file
+    in it is asked about, then whether files exist and their sizes are
+    answered from memory. Sizes are read when first asked for and kept.
+    Files downloaded and directories made are added as they happen, and
+    clear() forgets everything so changes made by anything else between
+    passes, such as retention, are seen.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.directories = {}
+
+    def clear(self):
+        with self.lock:
+            self.directories = {}
+
+    def listing(self, directory):
+        """Return {name: DirEntry or size} for the files in directory, or None if it does not exist."""
+        with self.lock:
+            if directory in self.directories:
+                return self.directories[directory]
+        try:
+            with os.scandir(directory or ".") as entries:
+                files = {entry.name: entry for entry in entries if entry.is_file()}
+        except (FileNotFoundError, NotADirectoryError):
+            files = None
+        with self.lock:
+            return self.directories.setdefault(directory, files)
+
+    def size(self, path):
+        """Return the size of a file, or None if it does not exist."""
+        (directory, name) = os.path.split(path)
+        files = self.listing(directory)
+        if files is None or name not in files:
+            return None
+        entry = files[name]
+        if isinstance(entry, int):
+            return entry
+        try:
+            size = entry.stat().st_size
+        except FileNotFoundError:
+            size = None
+        with self.lock:
+            if size is None:
+                files.pop(name, None)
+            else:
+                files[name] = size
+        return size
+
+    def exists(self, path):
+        return self.size(path) is not None
+
+    def directory_exists(self, directory):
+        return self.listing(directory) is not None
+
+    def make_directory(self, directory):
+        if not self.directory_exists(directory):
+            logger.debug("Making dir {}".format(directory))
+            os.makedirs(directory, exist_ok=True)
+            with self.lock:
+                self.directories[directory] = {}
+
+    def add(self, path, size):
+        """Record a file written since its directory was read."""
+        (directory, name) = os.path.split(path)
+        with self.lock:
+            files = self.directories.get(directory)
+            if files is not None:
+                files[name] = size
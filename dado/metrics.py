@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Name: (type, help)
+METRICS = {
+    "dado_cycles_total": ("counter", "Passes run"),
+    "dado_camera_reachable": ("gauge", "Whether the camera answered at the start of the last pass"),
+    "dado_cycle_seconds": ("gauge", "Duration of the last pass"),
+    "dado_stage_seconds": ("gauge", "Time spent in each stage during the last pass"),
+    "dado_stage_seconds_total": ("counter", "Time spent in each stage"),
+    "dado_downloaded_files_total": ("counter", "Files downloaded"),
+    "dado_downloaded_bytes_total": ("counter", "Bytes downloaded"),
+    "dado_download_retries_total": ("counter", "Download attempts repeated after a failure"),
+    "dado_download_failures_total": ("counter", "Downloads that failed after all attempts"),
+    "dado_download_throughput_bytes_per_second": ("gauge", "Download rate while downloads were running in the last pass"),
+    "dado_throttle_seconds_total": ("counter", "Time downloads were held back by the rate limiter"),
+    "dado_download_rate_bytes_per_second": ("gauge", "Download rate achieved by each kind of download in the last pass"),
+    "dado_download_rate_limit_bytes_per_second": ("gauge", "Download rate limit for each kind of download, 0 for none"),
+    "dado_link_throughput_bytes_per_second": ("gauge", "Measured throughput of the link to the camera"),
+    "dado_motion_frames_total": ("counter", "Thumbnails processed by motion detection"),
+    "dado_motion_frames_per_second": ("gauge", "Motion detection rate in the last pass"),
+    "dado_merges_total": ("counter", "Merges attempted"),
+    "dado_merge_seconds_total": ("counter", "Time spent merging"),
+    "dado_last_merge_seconds": ("gauge", "Duration of the last merge"),
+    "dado_backlog_recordings": ("gauge", "Recordings on the camera not yet processed by motion detection"),
+    "dado_backlog_files": ("gauge", "Files left to download after the last pass"),
+    "dado_trimmed_seconds_total": ("counter", "Seconds of video without motion trimmed from merged recordings"),
+    "dado_trimmed_bytes_total": ("counter", "Bytes trimmed from merged recordings"),
+    "dado_stored_bytes": ("gauge", "Size of the files kept under the output directory by kind"),
+    "dado_retention_removed_files_total": ("counter", "Files removed by retention"),
+    "dado_retention_reclaimed_bytes_total": ("counter", "Bytes reclaimed by retention"),
+    "dado_retention_seconds": ("gauge", "Time taken to apply retention in the last pass"),
+}
+
+
+class Metrics:
+    """Counters and gauges describing what the daemon has been doing.
+
+    Values are kept per metric name and set of labels. Time spent in each
+    stage of a pass is accumulated with stage() and published when the
+    pass ends, along with a summary of the pass for the log. Updates may
+    come from any thread. Labels bound to a thread with bind() are added to
+    everything it updates, so several cameras can run passes at once, each
+    with its own stage times and summary. Listeners added to listeners have
+    enter(name) and exit(name) called at the boundaries of each stage, e.g.
+    to profile them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.values = {}
+        self.stages = {}
+        self.snapshot = {}
+        self.cycle_started = {}
+        self.listeners = []
+
+    def bind(self, **labels):
+        """Add labels to every metric updated from this thread, e.g. the camera it works for."""
+        self.local.labels = labels
+
+    def context(self):
+        return tuple(sorted(getattr(self.local, 'labels', {}).items()))
+
+    def key(self, labels):
+        bound = getattr(self.local, 'labels', None)
+        if bound:
+            labels = dict(bound, **labels)
+        return tuple(sorted(labels.items()))
+
+    def in_context(self, key, context):
+        return all(label in key for label in context)
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            series = self.values.setdefault(name, {})
+            key = self.key(labels)
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values.setdefault(name, {})[self.key(labels)] = value
+
+    def add_stage_time(self, stage, seconds):
+        with self.lock:
+            stages = self.stages.setdefault(self.context(), {})
+            stages[stage] = stages.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name):
+        """Time the enclosed block as part of the named stage of this pass."""
+        for listener in self.listeners:
+            listener.enter(name)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage_time(name, time.perf_counter() - started)
+            for listener in reversed(self.listeners):
+                listener.exit(name)
+
+    def start_cycle(self):
+        context = self.context()
+        with self.lock:
+            self.stages[context] = {}
+            self.snapshot[context] = {name: dict(series) for (name, series) in self.values.items()
+                                      if METRICS.get(name, ("counter",))[0] == "counter"}
+            self.cycle_started[context] = time.monotonic()
+
+    def end_cycle(self, reachable):
+        """Publish the stage times for the pass and return a summary of it."""
+        context = self.context()
+        duration = time.monotonic() - self.cycle_started.get(context, time.monotonic())
+        self.inc("dado_cycles_total")
+        self.set("dado_camera_reachable", 1 if reachable else 0)
+        self.set("dado_cycle_seconds", duration)
+        with self.lock:
+            stages = dict(self.stages.get(context, {}))
+            series = self.values.get("dado_stage_seconds", {})
+            self.values["dado_stage_seconds"] = {key: value for (key, value) in series.items() if not self.in_context(key, context)}
+        for (stage, seconds) in stages.items():
+            self.set("dado_stage_seconds", seconds, stage=stage)
+            self.inc("dado_stage_seconds_total", seconds, stage=stage)
+        return self.summary()
+
+    def summary(self):
+        """Counters as totals for the current pass and gauges as they are now.
+
+        Labelled metrics are given as a dict keyed by the label value. Only
+        the metrics with the labels bound to this thread are included.
+        """
+        context = self.context()
+        summary = {}
+        with self.lock:
+            snapshot = self.snapshot.get(context, {})
+            for (name, series) in sorted(self.values.items()):
+                counter = METRICS.get(name, ("counter",))[0] == "counter"
+                if name == "dado_cycles_total":
+                    continue
+                short = name[len("dado_"):] if name.startswith("dado_") else name
+                if counter:
+                    short = short[:-len("_total")] if short.endswith("_total") else short
+                    if short == "stage_seconds":
+                        continue
+                values = {}
+                for (key, value) in series.items():
+                    if not self.in_context(key, context):
+                        continue
+                    if counter:
+                        value -= snapshot.get(name, {}).get(key, 0)
+                    labels = ",".join(str(text) for (label, text) in key if (label, text) not in context)
+                    values[labels] = round(value, 3) if isinstance(value, float) else value
+                if values:
+                    summary[short] = values[""] if list(values) == [""] else values
+        return summary
+
+    def render(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            for (name, series) in sorted(self.values.items()):
+                (kind, description) = METRICS.get(name, ("untyped", name))
+                lines.append("# HELP {} {}".format(name, description))
+                lines.append("# TYPE {} {}".format(name, kind))
+                for (key, value) in sorted(series.items()):
+                    labels = ",".join('{}="{}"'.format(label, str(text).replace('"', '\\"')) for (label, text) in key)
+                    lines.append("{}{} {}".format(name, "{" + labels + "}" if labels else "", value))
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """Serves the metrics over HTTP at /metrics for Prometheus to scrape."""
+
+    def __init__(self, metrics, address, port):
+        self.metrics = metrics
+        self.address = address
+        self.port = port
+
+    def start(self):
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    return self.send_error(404)
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer((self.address, self.port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True).start()
+        logger.info("Serving metrics on http://{}:{}/metrics".format(self.address, self.server.server_port))
+
+
+registry = Metrics()
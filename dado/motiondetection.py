@@ -4,9 +4,15 @@ import os.path
 import os
 import logging
 import datetime
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
 import numpy as np
-from skimage import io
+
+from imagediff import DIFFERS, calibrate, chunk_differences, mse
+from metrics import registry
 
 logger = logging.getLogger(__name__)
 
@@ -23,6 +29,16 @@ class MotionDetection:
         self.config = config
         self.state = state
         self.request_list = []
+        # Without a score_scale set, the one measured by calibration for the downscale is used
+        self.calibrated = self.config.get('engine', 'legacy') == 'fast' and self.config.get('score_scale') is None
+        if self.calibrated:
+            self.config['score_scale'] = (self.state.get('calibrated_score_scale') or {}).get(str(self.config.get('downscale', 4)))
+        self.differ = DIFFERS[self.config.get('engine', 'legacy')](self.config)
+        # Set once score_scale has been measured in this run
+        self.calibration_done = False
+        self.executor = None
+        self.budget = None
+        self.owner = None
 
         self.state_switcher = {
                 STATE_IDLE: self.idle,
@@ -81,34 +97,326 @@ class MotionDetection:
                                   "enddatetime": item['enddatetime'],
                                   "event": "motion"})
 
+    def unprocessed(self, item):
+        return not self.state.get('last_image_processed') or item['startdatetime'] >= self.state.get('last_image_processed')['enddatetime']
+
     def calculate_differences(self, list, field):
-        last_image = None
-        this_image = None
+        frames = sum(1 for item in list if self.unprocessed(item))
+        started = time.perf_counter()
+        try:
+            self.compare_images(list, field)
+        finally:
+            self.differ.flush()
+        duration = time.perf_counter() - started
+        registry.inc("dado_motion_frames_total", frames)
+        if frames > 0 and duration > 0:
+            registry.set("dado_motion_frames_per_second", frames / duration)
+
+    def compare_images(self, list, field):
+        if self.needs_calibration():
+            self.measure_score_scale([item[field] for item in list if self.unprocessed(item)])
+
+        if self.config.get('workers', 1) > 1:
+            self.calculate_parallel_differences(list, field)
+            return
+
+        if self.config.get('batch_size', 0) > 1 and hasattr(self.differ, 'differences'):
+            try:
+                self.calculate_batch_differences(list, field)
+                return
+            except ValueError as e:
+                logger.error("Error comparing images as a batch, comparing individually: {}".format(e))
+
+        last_path = None
+        this_path = None
+        images = {}
         for item in list:
-            if not self.state.get('last_image_processed') or item['startdatetime'] >= self.state.get('last_image_processed')['enddatetime']:
+            if self.unprocessed(item):
                 if os.path.isfile(item[field]) and os.stat(item[field]).st_size > 0:
-                    try:
-                        this_image = io.imread(item[field])
-                    except ValueError as e:
-                        logger.error("Error loading image for {}: {}".format(item[field], e))
+                    # Differences calculated before a restart are kept in the state store
+                    image_diff = None
+                    if last_path is not None:
+                        image_diff = self.state.image_diff(item[field], last_path, self.differ.settings)
 
-                    if last_image is not None and this_image is not None:
+                    if image_diff is not None:
+                        this_path = item[field]
+                        item['image_diff'] = image_diff
+                    else:
                         try:
-                            mse_val = round(MotionDetection.mse(last_image, this_image,), 1)
-                            # logger.debug("Calculating mse for {} as {}".format(item[field], mse_val))
-                            item['image_diff'] = mse_val
-                        except ValueError as e:
-                            logger.error("Error comparing images for {}: {}".format(item[field], e))
+                            images[item[field]] = self.differ.load(item[field])
+                            this_path = item[field]
+                        except (ValueError, OSError) as e:
+                            logger.error("Error loading image for {}: {}".format(item[field], e))
+
+                        if last_path is not None and this_path is not None:
+                            try:
+                                mse_val = round(self.differ.difference(self.load_image(images, last_path), images[this_path]), 1)
+                                # logger.debug("Calculating mse for {} as {}".format(item[field], mse_val))
+                                item['image_diff'] = mse_val
+                                if this_path == item[field]:
+                                    self.state.record_image_diff(this_path, last_path, self.differ.settings, mse_val)
+                            except (ValueError, OSError) as e:
+                                logger.error("Error comparing images for {}: {}".format(item[field], e))
+                                item['image_diff'] = 0
+                        else:
                             item['image_diff'] = 0
-                    else:
-                        item['image_diff'] = 0
 
                 else:
-                    logger.info("Skipping calculation as file does not exist or is empty for {}".format(item[field]))
+                    self.log_missing(item, field)
                     item['image_diff'] = 0
-            last_image = this_image
+            last_path = this_path
+            images = {last_path: images[last_path]} if last_path in images else {}
+
+    def needs_calibration(self):
+        """Return whether score_scale is to be measured before thumbnails are compared.
+
+        With calibrate set it is measured when there is no calibrated value
+        for the downscale yet, or once a run when recalibrate is also set or
+        score_scale is configured, in which case it is only reported.
+        """
+        if not self.config.get('calibrate') or not hasattr(self.differ, 'score_scale') or self.calibration_done:
+            return False
+        return self.config.get('score_scale') is None or self.config.get('recalibrate') or not self.calibrated
+
+    def scale_settled(self):
+        """Return whether scores are on the scale of the sensitivity, as score_scale is configured or calibrated."""
+        return not hasattr(self.differ, 'score_scale') or self.config.get('score_scale') is not None
+
+    def measure_score_scale(self, paths):
+        score_scale = calibrate([path for path in paths if os.path.isfile(path)], self.differ)
+        if score_scale:
+            self.calibration_done = True
+            if self.calibrated:
+                self.use_score_scale(score_scale)
+
+    def use_score_scale(self, score_scale):
+        """Use a score_scale measured by calibration, keeping it for the next run."""
+        calibrated = dict(self.state.get('calibrated_score_scale') or {})
+        calibrated[str(self.differ.downscale)] = score_scale
+        self.state['calibrated_score_scale'] = calibrated
+        self.config['score_scale'] = self.differ.score_scale = score_scale
+        logger.info("Using the calibrated score_scale of {:.2f}".format(score_scale))
+
+    def calculate_batch_differences(self, list, field):
+        """Calculate differences a batch of images at a time.
+
+        Gives the same results as calculate_differences: each image is
+        compared with the last image that loaded successfully, and the
+        first image, missing images and images that fail to load score 0.
+        As there, differences kept in the state store are used instead of
+        loading the images, here for batches where every image has one.
+        """
+        batch_size = self.config['batch_size']
+        pending = [item for item in list if self.unprocessed(item)]
+        previous = None
+        previous_path = None
+        for start in range(0, len(pending), batch_size):
+            batch = []
+            for item in pending[start:start + batch_size]:
+                item['image_diff'] = 0
+                if os.path.isfile(item[field]) and os.stat(item[field]).st_size > 0:
+                    batch.append(item)
+                else:
+                    self.log_missing(item, field)
+
+            stored = self.stored_differences(batch, field, previous_path)
+            if stored is not None:
+                for (item, image_diff) in zip(batch, stored):
+                    item['image_diff'] = image_diff
+                if batch:
+                    (previous, previous_path) = (None, batch[-1][field])
+                continue
+
+            if previous is None and previous_path is not None:
+                # The images of the last batch came from the state store
+                try:
+                    previous = self.differ.load(previous_path)
+                except (ValueError, OSError) as e:
+                    logger.error("Error comparing images for {}: {}".format(batch[0][field], e))
+            frames = [previous] if previous is not None else []
+            paths = [previous_path] if previous is not None else []
+            loaded = []
+            for item in batch:
+                try:
+                    frames.append(self.differ.load(item[field]))
+                    paths.append(item[field])
+                    loaded.append(item)
+                except (ValueError, OSError) as e:
+                    logger.error("Error loading image for {}: {}".format(item[field], e))
+
+            if previous is None and loaded:
+                # The first image has nothing to be compared with
+                loaded = loaded[1:]
+            rows = []
+            for (item, last_path, image_diff) in zip(loaded, paths, self.differ.differences(frames)):
+                item['image_diff'] = round(float(image_diff), 1)
+                rows.append((item[field], last_path, item['image_diff']))
+            self.state.record_image_diffs(rows, self.differ.settings)
+            if frames:
+                (previous, previous_path) = (frames[-1], paths[-1])
+
+    def stored_differences(self, batch, field, previous_path):
+        """Return the differences kept in the state store for a batch of images, or None if any is missing."""
+        stored = []
+        for item in batch:
+            image_diff = 0
+            if previous_path is not None:
+                image_diff = self.state.image_diff(item[field], previous_path, self.differ.settings)
+                if image_diff is None:
+                    return None
+            stored.append(image_diff)
+            previous_path = item[field]
+        return stored
+
+    def calculate_parallel_differences(self, list, field):
+        """Calculate differences using a pool of worker processes.
+
+        The images are split into chunks which are loaded and compared in
+        parallel, then the comparison between the last image of one chunk
+        and the first of the next is made here. Gives the same results as
+        calculate_differences.
+        """
+        pending = []
+        for item in list:
+            if self.unprocessed(item):
+                item['image_diff'] = 0
+                if os.path.isfile(item[field]) and os.stat(item[field]).st_size > 0:
+                    pending.append(item)
+                else:
+                    self.log_missing(item, field)
+
+        chunk_size = self.config.get('chunk_size', 64)
+        chunks = [pending[start:start + chunk_size] for start in range(0, len(pending), chunk_size)]
+        paths = [[item[field] for item in chunk] for chunk in chunks]
+        results = self.map_chunks(paths)
+
+        last_path = None
+        for (chunk, result) in zip(chunks, results):
+            for (item, (loaded, image_diff, error)) in zip(chunk, result):
+                if not loaded:
+                    logger.error("Error loading image for {}: {}".format(item[field], error))
+                    continue
+                if error:
+                    logger.error("Error comparing images for {}: {}".format(item[field], error))
+                elif image_diff is None and last_path is not None:
+                    try:
+                        image_diff = self.differ.difference(self.differ.load(last_path), self.differ.load(item[field]))
+                    except (ValueError, OSError) as e:
+                        logger.error("Error comparing images for {}: {}".format(item[field], e))
+                if image_diff is not None and not error:
+                    item['image_diff'] = round(float(image_diff), 1)
+                    self.state.record_image_diff(item[field], last_path, self.differ.settings, item['image_diff'])
+                last_path = item[field]
+
+    def map_chunks(self, paths):
+        """Calculate the differences for chunks of paths on the process pool, returning the results in order."""
+        if self.budget is None:
+            return self.process_pool().map(chunk_differences, repeat(self.config, len(paths)), paths)
+        # Chunks are submitted as slots in the shared pool become free, so other cameras get their turn
+        futures = []
+        for chunk in paths:
+            self.budget.acquire(self.owner)
+            future = self.executor.submit(chunk_differences, self.config, chunk)
+            future.add_done_callback(lambda future: self.budget.release(self.owner))
+            futures.append(future)
+        return (future.result() for future in futures)
+
+    def share(self, executor, budget, owner):
+        """Use a process pool shared with other cameras, taking a slot from budget for each chunk run for owner."""
+        self.executor = executor
+        self.budget = budget
+        self.owner = owner
+
+    def process_pool(self):
+        if self.executor is None:
+            workers = self.config['workers']
+            logger.debug("Starting {} motion detection worker processes".format(workers))
+            self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        return self.executor
+
+    def log_missing(self, item, field):
+        if item.get('sampled', True):
+            logger.info("Skipping calculation as file does not exist or is empty for {}".format(item[field]))
+
+    def sample_thumbnails(self, list, field, fetch):
+        """Fetch only the thumbnails needed to find changes.
+
+        Every sample_interval'th unprocessed thumbnail is fetched first and
+        each sample is compared with the one before it. Only where that
+        difference exceeds the sensitivity, or a sample is missing, are the
+        thumbnails in between fetched, so they can be compared one by one
+        as usual. Thumbnails that are not fetched are marked as not sampled
+        and score 0. A change that is over before the next sample is taken
+        is not detected.
+
+        Samples are only compared once the scores are on the scale of the
+        sensitivity, so calibration is made from the samples first when it
+        is needed, and every thumbnail is fetched when it cannot be.
+        """
+        interval = self.config['sample_interval']
+        pending = [item for item in list if self.unprocessed(item)]
+        if len(pending) <= 2:
+            fetch(list)
+            return list
+
+        indices = [index for index in range(0, len(pending), interval)]
+        if indices[-1] != len(pending) - 1:
+            indices.append(len(pending) - 1)
+        for item in pending:
+            item['sampled'] = False
+        samples = [pending[index] for index in indices]
+        for item in samples:
+            item['sampled'] = True
+        fetch(samples)
+
+        if self.needs_calibration():
+            self.measure_score_scale([item[field] for item in samples])
+        if not self.scale_settled():
+            logger.info("Fetching every thumbnail as there is no score_scale configured or calibrated to compare samples with")
+            rest = [item for item in pending if not item['sampled']]
+            for item in rest:
+                item['sampled'] = True
+            fetch(rest)
+            return list
+
+        frames = {}
+        for item in samples:
+            try:
+                if os.path.isfile(item[field]) and os.stat(item[field]).st_size > 0:
+                    frames[item[field]] = self.differ.load(item[field])
+            except (ValueError, OSError) as e:
+                logger.error("Error loading image for {}: {}".format(item[field], e))
+
+        fill = []
+        for (start, end) in zip(indices, indices[1:]):
+            (first, last) = (frames.get(pending[start][field]), frames.get(pending[end][field]))
+            try:
+                changed = first is None or last is None or self.differ.difference(first, last) > self.config['sensitivity']
+            except ValueError:
+                changed = True
+            if changed:
+                fill.extend(pending[start + 1:end])
+        for item in fill:
+            item['sampled'] = True
+        if fill:
+            fetch(fill)
+        self.differ.flush()
+
+        logger.info("Fetched {} of {} thumbnails, {} sampled and {} around changes".format(
+            len(samples) + len(fill), len(pending), len(samples), len(fill)))
+        return list
+
+    def load_image(self, images, path):
+        if path not in images:
+            images[path] = self.differ.load(path)
+        return images[path]
 
     def identify_requests(self, list):
+        if self.config.get('requests_engine', 'vectorized') == 'legacy':
+            return self.identify_requests_legacy(list)
+        return self.identify_requests_vectorized(list)
+
+    def identify_requests_legacy(self, list):
         self.status = STATE_IDLE
         self.trigger_start_image = None
         self.count_threshold = None
@@ -122,9 +430,9 @@ class MotionDetection:
             logger.debug("{} Event status: {}. Current image change from last image: {}".format(item['start_timestamp'], self.status, item.get('image_diff', 'None')))
             func(last)
 
-            # Update the last processed state for the next run. Only do this when idle
+            # Update the last processed state for the next run, saved once the requests are finished. Only do this when idle
             if self.status == STATE_IDLE and last and not self.image_triggered(item):
-                self.state['last_image_processed'] = last
+                self.state.hold('last_image_processed', last)
 
             # Split the recording if longer than the max. Update the state also to allow next run to continue from here
             if self.status == STATE_RECORDING and last:
@@ -132,13 +440,107 @@ class MotionDetection:
                 if item['enddatetime'] > self.trigger_start_image['startdatetime'] + max:
                     self.request_recording(last)
                     self.trigger_start_image = item
-                    self.state['last_image_processed'] = last
+                    self.state.hold('last_image_processed', last)
             last = item
         return self.request_list
 
+    def triggered_series(self, list):
+        """Return whether each item's image_diff is over the sensitivity as an array."""
+        if hasattr(list, 'column'):
+            image_diffs = np.nan_to_num(list.column('image_diff'), nan=0.0)
+        else:
+            image_diffs = np.array([item.get('image_diff', 0) for item in list], dtype=np.float64)
+        return image_diffs > self.config['sensitivity']
+
+    def identify_requests_vectorized(self, list):
+        """Find the same requests as identify_requests_legacy from runs of triggered images.
+
+        The legacy state machine steps through each item one behind the
+        item being looked at, starting with the first item twice, so the
+        series it sees is shifted by one. A recording starts once a run of
+        triggered images is longer than start_count and stops once a run of
+        untriggered images is longer than stop_count (and at least one), so
+        the runs long enough to start and stop a recording are found at
+        once and only the items while recording are looked at one by one,
+        to split recordings longer than maximum_video_length.
+        """
+        self.request_list = []
+        if len(list) == 0:
+            return self.request_list
+
+        # current[i] is triggered(list[i]), stepped[i] is the item the state machine steps with at i
+        current = self.triggered_series(list)
+        stepped = np.concatenate((current[:1], current[:-1]))
+        count_in = max(int(self.config['start_count']), 0)
+        count_out = max(int(self.config['stop_count']), 1)
+        maximum = datetime.timedelta(seconds=self.config['maximum_video_length'])
+
+        (starts, lengths, values) = runs(stepped)
+        recording_starts = starts[values & (lengths > count_in)]
+        stopping_runs = starts[~values & (lengths > count_out)]
+
+        # Count the items from the start of each recording to the item stopping it, as these are not idle
+        active = np.zeros(len(list) + 1, dtype=np.int64)
+        last_processed = []
+        position = 0
+        while True:
+            index = np.searchsorted(recording_starts, position)
+            if index == len(recording_starts):
+                break
+            trigger = self.stepped_item(list, int(recording_starts[index]))
+            begin = int(recording_starts[index]) + count_in
+            logger.info("Detected a recording starting at {}".format(self.stepped_item(list, begin)['start_timestamp']))
+            index = np.searchsorted(stopping_runs, begin)
+            stop = int(stopping_runs[index]) + count_out if index < len(stopping_runs) else None
+            active[begin] += 1
+            active[len(list) if stop is None else stop] -= 1
+
+            # Items where the state machine is recording rather than counting out, in order
+            recording = begin + np.flatnonzero(stepped[begin:stop])
+            ends = np.array([list[int(item)]['enddatetime'] for item in recording] + [None], dtype=object)[:-1]
+            while len(recording) > 0:
+                split = np.flatnonzero(ends > trigger['startdatetime'] + maximum)
+                if len(split) == 0:
+                    break
+                at = int(recording[split[0]])
+                self.request_list.append(self.motion_request(trigger, self.stepped_item(list, at)))
+                trigger = list[at]
+                last_processed.append(at)
+                (recording, ends) = (recording[split[0] + 1:], ends[split[0] + 1:])
+
+            if stop is None:
+                break
+            logger.info("Detected a recording finishing at {}".format(self.stepped_item(list, stop)['start_timestamp']))
+            self.request_list.append(self.motion_request(trigger, self.stepped_item(list, stop)))
+            position = stop
+
+        # The state is updated when idle and the item being looked at is not triggered
+        idle = (np.cumsum(active)[:-1] == 0) & ~stepped & ~current
+        if idle.any():
+            last_processed.append(int(np.flatnonzero(idle)[-1]))
+        if last_processed:
+            self.state.hold('last_image_processed', self.stepped_item(list, max(last_processed)))
+        return self.request_list
+
+    def stepped_item(self, list, index):
+        return list[max(index - 1, 0)]
+
+    def motion_request(self, start, end):
+        logger.info("Requesting recording {} to {}".format(start['startdatetime'], end['enddatetime']))
+        return {"start": start,
+                "end": end,
+                "startdatetime": start['startdatetime'],
+                "enddatetime": end['enddatetime'],
+                "event": "motion"}
+
     @staticmethod
     def mse(imageA, imageB):
         """Compare image content to allow a difference number to be used as a trigger."""
-        err = np.sum((imageA.astype("float") - imageB.astype("float")) ** 2)
-        err /= float(imageA.shape[0] * imageA.shape[1])
-        return err
+        return mse(imageA, imageB)
+
+
+def runs(series):
+    """Split a boolean array into runs of equal values, returning their starts, lengths and values."""
+    starts = np.concatenate(([0], np.flatnonzero(series[1:] != series[:-1]) + 1))
+    lengths = np.diff(np.append(starts, len(series)))
+    return (starts, lengths, series[starts])
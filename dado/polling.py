@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+import logging
+from collections import deque
+from math import ceil, log2
+
+from util import plural
+
+logger = logging.getLogger(__name__)
+
+
+class PollScheduler:
+    """Decides how long the daemon waits before its next cycle.
+
+    While the camera is unreachable the wait starts at unreachable_interval
+    and doubles after each failed attempt up to unreachable_max_interval.
+    When a cycle made progress but left files behind the next cycle starts
+    after backlog_interval. Otherwise the configured sleep_interval is used.
+    The duration of recent cycles is kept in timings.
+    """
+
+    def __init__(self, config):
+        polling = config.get('polling') or {}
+        self.interval = int(config.get('sleep_interval'))
+        self.unreachable_interval = polling.get('unreachable_interval', 30)
+        self.unreachable_max_interval = polling.get('unreachable_max_interval', self.interval)
+        self.backlog_interval = polling.get('backlog_interval', 0)
+        self.failures = 0
+        # Doubling more often than this passes the maximum, so the exponent is kept within it
+        self.max_doublings = 0
+        if 0 < self.unreachable_interval < self.unreachable_max_interval:
+            self.max_doublings = ceil(log2(self.unreachable_max_interval / self.unreachable_interval))
+        self.timings = deque(maxlen=polling.get('timing_history', 100))
+
+    def next_interval(self, reachable, backlog, progress):
+        """Return the number of seconds to wait and the reason for it."""
+        if not reachable:
+            interval = min(self.unreachable_max_interval, self.unreachable_interval * 2 ** min(self.failures, self.max_doublings))
+            self.failures += 1
+            return (interval, "camera unreachable {} time{}".format(self.failures, plural(self.failures)))
+
+        self.failures = 0
+        if backlog > 0 and progress:
+            return (self.backlog_interval, "{} file{} still to download".format(backlog, plural(backlog)))
+        if backlog > 0:
+            return (self.interval, "no progress made with {} file{} still to download".format(backlog, plural(backlog)))
+        return (self.interval, "up to date")
+
+    def record(self, duration, reachable, backlog, interval):
+        self.timings.append({"duration": duration,
+                             "reachable": reachable,
+                             "backlog": backlog,
+                             "interval": interval})
+        reachable_cycles = [timing['duration'] for timing in self.timings if timing['reachable']]
+        if reachable_cycles:
+            logger.info("Cycle took {:.1f}s, average {:.1f}s over the last {} cycle{} with the camera available".format(
+                duration, sum(reachable_cycles) / len(reachable_cycles), len(reachable_cycles), plural(len(reachable_cycles))))
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+import cProfile
+import io
+import json
+import logging
+import pstats
+import threading
+import time
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+ROOT_SPAN = "total"
+
+
+class CycleProfiler:
+    """Profiles passes of the daemon, grouped by the stage being run.
+
+    Listens to the stages timed by the metrics registry and keeps a
+    separate cProfile profile for each, so time is attributed to the stage
+    it was spent in. Time outside any stage goes to the "total" profile,
+    which is timed from start() to stop() and so includes the stages. Only the
+    thread that started the profiler is profiled, work done on download
+    and merge threads shows as waiting in the stage that started it.
+
+    The peak memory allocated by Python during each stage is measured with
+    tracemalloc. Before Python 3.9 the peak can only be seen when it is
+    higher than any earlier peak, so smaller peaks are reported as the
+    memory still allocated at the end of the stage.
+    """
+
+    def __init__(self, output, top=25):
+        self.output = output
+        self.top = top
+        self.thread = threading.get_ident()
+        self.profiles = {}
+        self.spans = {}
+        self.stack = []
+
+    def start(self):
+        tracemalloc.start()
+        self.enter(ROOT_SPAN)
+
+    def stop(self):
+        self.exit(ROOT_SPAN)
+        tracemalloc.stop()
+
+    def profile(self, name):
+        if name not in self.profiles:
+            self.profiles[name] = cProfile.Profile()
+        return self.profiles[name]
+
+    def enter(self, name):
+        if threading.get_ident() != self.thread:
+            return
+        (current, peak) = tracemalloc.get_traced_memory()
+        if self.stack:
+            self.profile(self.stack[-1]['name']).disable()
+            self.stack[-1]['peak'] = max(self.stack[-1]['peak'], peak)
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+            peak = current
+        self.stack.append({"name": name, "started": time.perf_counter(), "current": current, "start_peak": peak, "peak": peak})
+        self.profile(name).enable()
+
+    def exit(self, name):
+        if threading.get_ident() != self.thread or not self.stack or self.stack[-1]['name'] != name:
+            return
+        self.profile(name).disable()
+        entry = self.stack.pop()
+        (current, peak) = tracemalloc.get_traced_memory()
+        peak = max(peak, entry['peak'])
+        if peak <= entry['start_peak']:
+            # The peak was not raised, only what is still allocated is known
+            peak = max(current, entry['current'])
+        span = self.spans.setdefault(name, {"calls": 0, "seconds": 0.0, "peak_bytes": 0})
+        span['calls'] += 1
+        span['seconds'] += time.perf_counter() - entry['started']
+        span['peak_bytes'] = max(span['peak_bytes'], peak - entry['current'])
+        if self.stack:
+            self.stack[-1]['peak'] = max(self.stack[-1]['peak'], peak)
+            self.profile(self.stack[-1]['name']).enable()
+
+    def stats(self, name=None, stream=None):
+        """Return the statistics for a span, or for all of them combined."""
+        names = [name] if name else [span for span in self.profiles if self.profiles[span].getstats()]
+        stats = None
+        for span in names:
+            if stats is None:
+                stats = pstats.Stats(self.profiles[span], stream=stream)
+            else:
+                stats.add(self.profiles[span])
+        return stats
+
+    def write(self):
+        """Write the profiles and a summary of the spans alongside output."""
+        self.stats().dump_stats(self.output)
+        for name in self.spans:
+            self.stats(name).dump_stats("{}.{}".format(self.output, name))
+        with open(self.output + ".json", 'w') as f:
+            json.dump(self.spans, f, indent=1, sort_keys=True)
+        logger.info("Profile written to {} with a file per stage and a summary in {}.json".format(self.output, self.output))
+
+    def report(self):
+        """Return a report of the spans and the hottest functions."""
+        output = io.StringIO()
+        output.write("{:<16} {:>6} {:>10} {:>12}\n".format("Stage", "Calls", "Seconds", "Peak MB"))
+        for (name, span) in sorted(self.spans.items(), key=lambda item: -item[1]['seconds']):
+            output.write("{:<16} {:>6} {:>10.3f} {:>12.1f}\n".format(name, span['calls'], span['seconds'], span['peak_bytes'] / 1048576))
+
+        output.write("\nTop {} functions by own time over all stages:\n".format(self.top))
+        self.stats(stream=output).sort_stats("tottime").print_stats(self.top)
+        for name in sorted(self.spans, key=lambda name: -self.spans[name]['seconds']):
+            output.write("\nTop {} functions by cumulative time in {}:\n".format(min(self.top, 10), name))
+            self.stats(name, output).sort_stats("cumulative").print_stats(min(self.top, 10))
+        return output.getvalue()
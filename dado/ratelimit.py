@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+import logging
+import threading
+import time
+from datetime import datetime, time as time_of_day
+
+from scheduler import CLASSES
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+TOTAL = "total"
+
+
+def parse_time(value):
+    """Return a time of day given as "HH:MM", or as the minutes YAML reads an unquoted HH:MM as."""
+    if isinstance(value, time_of_day):
+        return value
+    if isinstance(value, int) and not isinstance(value, bool) and 0 <= value < 24 * 60:
+        return time_of_day(*divmod(value, 60))
+    if isinstance(value, str):
+        try:
+            return datetime.strptime(value.strip(), "%H:%M").time()
+        except ValueError:
+            pass
+    raise ValueError("Not a time of day in the rate limit schedule: {!r}".format(value))
+
+
+class TokenBucket:
+    """Limits a flow of bytes to a rate, allowing bursts of burst seconds.
+
+    A chunk larger than the bucket is let through and the debt paid off by
+    the callers that follow, so any chunk size can be used.
+    """
+
+    def __init__(self, rate=None, burst=1.0):
+        self.lock = threading.Lock()
+        self.burst = burst
+        self.rate = None
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self.lock:
+            if rate != self.rate:
+                self.rate = rate
+                self.tokens = rate * self.burst if rate else 0.0
+                self.updated = time.monotonic()
+
+    def reserve(self, size):
+        """Take size bytes from the bucket, returning the seconds to wait before using them."""
+        with self.lock:
+            if not self.rate:
+                return 0.0
+            now = time.monotonic()
+            self.tokens = min(self.rate * self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= size
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class LinkMeter:
+    """Measures the throughput of the link to the camera.
+
+    Bytes received are divided by the time at least one download was
+    receiving data, time when every download was held back by the rate
+    limiter is left out so the measurement is of the link, not the limit.
+    The estimate is smoothed across cycles.
+    """
+
+    def __init__(self, smoothing=0.5, minimum_bytes=4194304):
+        self.lock = threading.Lock()
+        self.smoothing = smoothing
+        self.minimum_bytes = minimum_bytes
+        self.streams = 0
+        self.waiting = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.since = time.monotonic()
+        self.estimate = None
+
+    def update(self, streams=0, waiting=0):
+        now = time.monotonic()
+        if self.streams > self.waiting:
+            self.seconds += now - self.since
+        self.since = now
+        self.streams += streams
+        self.waiting += waiting
+
+    def change(self, streams=0, waiting=0):
+        with self.lock:
+            self.update(streams, waiting)
+
+    def record(self, size):
+        with self.lock:
+            self.bytes += size
+
+    def sample(self):
+        """Update the estimate once minimum_bytes have been received, normally once a cycle."""
+        with self.lock:
+            self.update()
+            if self.bytes >= self.minimum_bytes and self.seconds > 0:
+                rate = self.bytes / self.seconds
+                self.estimate = rate if self.estimate is None else self.smoothing * rate + (1 - self.smoothing) * self.estimate
+                self.bytes = 0
+                self.seconds = 0.0
+            return self.estimate
+
+
+class RateLimiter:
+    """Shapes camera downloads to per class budgets.
+
+    Each class of download (event, thumbnail, original and backfill) has
+    its own token bucket, with rates in bytes per second from the config
+    and None for no limit. Entries in schedule replace the rates between
+    their start and end times of day. With link_share set all downloads
+    together are also limited to that share of the measured link
+    throughput, leaving the rest for other users of the link.
+    """
+
+    def __init__(self, config):
+        config = config or {}
+        self.config = config
+        self.burst = config.get('burst_seconds', 2.0)
+        self.link_share = config.get('link_share')
+        self.schedule = [(parse_time(entry['start']), parse_time(entry['end']), entry) for entry in config.get('schedule') or []]
+        self.meter = LinkMeter(minimum_bytes=config.get('link_sample_bytes', 4194304))
+        self.buckets = {kind: TokenBucket(burst=self.burst) for kind in list(CLASSES.values()) + [TOTAL]}
+        self.lock = threading.Lock()
+        self.reset_statistics()
+
+    def reset_statistics(self):
+        with self.lock:
+            self.achieved = {}
+            self.waited = 0.0
+
+    def scheduled(self, now=None):
+        """Return the schedule entry in force at now, if any."""
+        now = (now or datetime.now()).time().replace(second=0, microsecond=0)
+        for (start, end, entry) in self.schedule:
+            if (start <= now < end) if start <= end else (now >= start or now < end):
+                return entry
+        return {}
+
+    def rates(self, now=None):
+        """Return the configured rate for each class at now.
+
+        Backfill downloads are limited to the rate for originals unless a
+        rate is set for them, as a blank value in the config or a schedule
+        entry without one is not meant to leave them unlimited.
+        """
+        entry = self.scheduled(now)
+        rates = {}
+        for kind in list(CLASSES.values()) + [TOTAL]:
+            rates[kind] = entry.get(kind, self.config.get(kind))
+        if rates['backfill'] is None:
+            rates['backfill'] = rates['original']
+        if self.link_share and self.meter.estimate:
+            share = self.link_share * self.meter.estimate
+            rates[TOTAL] = min(rates[TOTAL], share) if rates[TOTAL] else share
+        return rates
+
+    def apply(self):
+        """Bring the buckets up to date with the schedule and the link measurement."""
+        for (kind, rate) in self.rates().items():
+            self.buckets[kind].set_rate(rate)
+
+    def start(self):
+        self.meter.change(streams=1)
+
+    def finish(self):
+        self.meter.change(streams=-1)
+
+    def reserve(self, priority, size):
+        """Account for size bytes received, returning the seconds to wait before reading more."""
+        kind = CLASSES[priority]
+        self.meter.record(size)
+        delay = max(self.buckets[kind].reserve(size), self.buckets[TOTAL].reserve(size))
+        now = time.monotonic()
+        with self.lock:
+            if kind in self.achieved:
+                (first, last, total) = self.achieved[kind]
+                self.achieved[kind] = (first, max(last, now + delay), total + size)
+            else:
+                # The rate is measured from the end of the first chunk
+                self.achieved[kind] = (now, now + delay, 0)
+        return delay
+
+    def waiting(self, delay):
+        with self.lock:
+            self.waited += delay
+        registry.inc("dado_throttle_seconds_total", delay)
+        self.meter.change(waiting=1)
+
+    def waited_for(self):
+        self.meter.change(waiting=-1)
+
+    def throttle(self, priority, size):
+        """Account for size bytes received and wait until more can be read."""
+        delay = self.reserve(priority, size)
+        if delay > 0:
+            self.waiting(delay)
+            try:
+                time.sleep(delay)
+            finally:
+                self.waited_for()
+
+    def report(self):
+        """Log the rates achieved by each class since the last report against those configured."""
+        rates = self.rates()
+        self.meter.sample()
+        with self.lock:
+            (achieved, waited) = (self.achieved, self.waited)
+        for (kind, (first, last, total)) in sorted(achieved.items()):
+            rate = total / (last - first) if last > first else None
+            registry.set("dado_download_rate_bytes_per_second", rate or 0, kind=kind)
+            registry.set("dado_download_rate_limit_bytes_per_second", rates[kind] or 0, kind=kind)
+            if rates[kind] or rates[TOTAL]:
+                logger.info("Downloaded {} at {} against a limit of {}".format(
+                    kind, self.format_rate(rate), self.format_rate(rates[kind] or rates[TOTAL])))
+        if self.meter.estimate:
+            registry.set("dado_link_throughput_bytes_per_second", self.meter.estimate)
+            logger.info("Measured link throughput {}, held back for {:.1f}s".format(self.format_rate(self.meter.estimate), waited))
+        self.reset_statistics()
+
+    def format_rate(self, rate):
+        return "{:.2f} MB/s".format(rate / 1048576) if rate else "unknown"
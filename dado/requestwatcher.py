@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import os
+import ctypes
+import ctypes.util
+import logging
+import struct
+import threading
+
+logger = logging.getLogger(__name__)
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CLOEXEC = os.O_CLOEXEC
+EVENT = struct.Struct("iIII")
+BUFFER_SIZE = 64 * (EVENT.size + 256)
+
+
+class RequestWatcher:
+    """Wakes the daemon as soon as a manual request is written to the requests directory.
+
+    Uses Linux inotify through the C library. Where inotify is not available
+    the watcher does not start and requests are picked up on the next pass.
+    """
+
+    def __init__(self, directory, extension, event):
+        self.directory = directory
+        self.extension = extension.lower()
+        self.event = event
+        self.fd = None
+
+    def start(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+            if libc.inotify_add_watch(fd, os.fsencode(self.directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        except (OSError, AttributeError) as e:
+            logger.info("Unable to watch {} for manual requests: {}".format(self.directory, e))
+            return False
+
+        self.fd = fd
+        threading.Thread(target=self.run, name="request-watcher", daemon=True).start()
+        logger.info("Watching {} for manual requests".format(self.directory))
+        return True
+
+    def run(self):
+        while True:
+            data = os.read(self.fd, BUFFER_SIZE)
+            offset = 0
+            while offset < len(data):
+                (wd, mask, cookie, length) = EVENT.unpack_from(data, offset)
+                name = os.fsdecode(data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b"\0"))
+                offset += EVENT.size + length
+                if name.lower().endswith(self.extension):
+                    logger.info("Manual request {} received".format(name))
+                    self.event.set()
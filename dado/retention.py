@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+import os.path
+import os
+import logging
+import re
+import time
+from datetime import datetime
+
+from util import plural
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Kind of file: the option giving its path
+KINDS = {
+    "event": "event_filename",
+    "thumbnail": "thumbnail_filename",
+    "original": "original_filename",
+    "recording": "recording_filename",
+}
+
+
+class RetentionManager:
+    """Keeps the files under the output directory within their limits.
+
+    Works from the index of local files kept in the state store, which
+    records the kind of each file, its size and the time of the recording
+    it holds, so the tree is only walked once to index files downloaded
+    before the index existed. After each pass the originals of merges that
+    were verified are removed when remove_merged_originals is set,
+    thumbnails older than retention.thumbnail_days are removed, and while
+    the files take up more than retention.quota_mb the oldest are removed.
+    Events and the files of manual requests are never removed to keep
+    within the quota.
+    """
+
+    def __init__(self, config, state):
+        self.config = config
+        self.retention = config.get('retention') or {}
+        self.state = state
+        self.root = config['output_root']
+
+    def file_pattern(self, kind):
+        """Return a regular expression matching the paths of a kind of file, relative to the output directory."""
+        template = self.config[KINDS[kind]] + (self.config.get('recording_extension', '') if kind == "recording" else "")
+        parts = re.split(r"(\{[^}]*\})", template)
+        return re.compile("".join("(?P<event>[^/]*)" if part == "{event}" else ".*" if part.startswith("{") else re.escape(part)
+                                  for part in parts) + "$")
+
+    def index_existing(self):
+        """Index the files already under the output directory, once."""
+        if self.state.get('files_indexed'):
+            return
+        started = time.perf_counter()
+        patterns = [(kind, self.file_pattern(kind)) for kind in KINDS]
+        partial = (self.config.get('camera') or {}).get('partial_extension', '.part')
+        rows = []
+        for (dirpath, dirnames, files) in os.walk(self.root):
+            if dirpath == self.root:
+                # Skip the state and the manual requests
+                dirnames[:] = [name for name in dirnames if not name.startswith('.') and name != self.config.get('manual_request_dir')]
+            for name in files:
+                if name.endswith(partial):
+                    continue
+                path = os.path.join(dirpath, name)
+                relative = os.path.relpath(path, self.root).replace(os.sep, "/")
+                for (kind, pattern) in patterns:
+                    match = pattern.match(relative)
+                    if match:
+                        stat = os.stat(path)
+                        manual = kind == "event" or match.groupdict().get('event') == "manual"
+                        rows.append((path, kind, stat.st_size, stat.st_mtime, manual))
+                        break
+        self.state.index_files(rows)
+        self.state['files_indexed'] = datetime.now()
+        logger.info("Indexed {} existing file{} in {:.1f}s".format(len(rows), plural(len(rows)), time.perf_counter() - started))
+
+    def run(self, merged_originals=()):
+        """Remove the files that are no longer needed, returning the bytes reclaimed."""
+        with registry.stage("retention"):
+            started = time.perf_counter()
+            self.index_existing()
+            removed = {}
+            if self.config.get('remove_merged_originals') and merged_originals:
+                self.remove([(path, "original", None) for path in merged_originals], removed)
+            if self.retention.get('thumbnail_days'):
+                self.prune_thumbnails(removed)
+            if self.retention.get('quota_mb'):
+                self.enforce_quota(removed)
+            duration = time.perf_counter() - started
+        return self.report(removed, duration)
+
+    def prune_thumbnails(self, removed):
+        before = time.time() - self.retention['thumbnail_days'] * 86400
+        if self.state.get('last_image_processed'):
+            # Thumbnails still to be compared by motion detection are kept
+            before = min(before, self.state['last_image_processed']['startdatetime'].timestamp())
+        self.remove([(path, "thumbnail", size) for (path, size) in self.state.files_recorded_before("thumbnail", before)], removed)
+
+    def enforce_quota(self, removed):
+        quota = self.retention['quota_mb'] * 1048576
+        used = sum(size for (count, size) in self.state.stored_files().values())
+        if used <= quota:
+            return
+        evict = []
+        for (path, kind, size) in self.state.removable_files():
+            if used <= quota:
+                break
+            evict.append((path, kind, size))
+            used -= size
+        if used > quota:
+            logger.warning("Files take up {:.0f} MB, over the quota of {:.0f} MB, after removing all but events and manual requests".format(
+                used / 1048576, quota / 1048576))
+        self.remove(evict, removed)
+
+    def remove(self, files, removed):
+        """Delete files given as (path, kind, size), adding the count and bytes reclaimed by kind to removed."""
+        forget = []
+        for (path, kind, size) in files:
+            try:
+                size = os.stat(path).st_size
+                os.remove(path)
+                logger.debug("Removed {} {}".format(kind, path))
+            except FileNotFoundError:
+                size = 0
+            except OSError as e:
+                logger.error("Error removing {}: {}".format(path, e))
+                continue
+            if kind == "recording":
+                manifest = path + self.config.get('manifest_extension', '.manifest')
+                if os.path.isfile(manifest):
+                    os.remove(manifest)
+            (count, total) = removed.get(kind, (0, 0))
+            removed[kind] = (count + 1, total + size)
+            forget.append(path)
+        self.state.forget_files(forget)
+
+    def report(self, removed, duration):
+        stored = self.state.stored_files()
+        for (kind, (count, size)) in stored.items():
+            if kind:
+                registry.set("dado_stored_bytes", size, kind=kind)
+        for (kind, (count, size)) in removed.items():
+            registry.inc("dado_retention_removed_files_total", count, kind=kind)
+            registry.inc("dado_retention_reclaimed_bytes_total", size, kind=kind)
+        registry.set("dado_retention_seconds", duration)
+        reclaimed = sum(size for (count, size) in removed.values())
+        kept = sum(size for (count, size) in stored.values()) / 1048576
+        if removed:
+            files = sum(count for (count, size) in removed.values())
+            logger.info("Removed {} file{} ({}), reclaiming {:.1f} MB in {:.2f}s, {:.1f} MB kept".format(
+                files, plural(files), ", ".join("{} {}".format(count, kind) for (kind, (count, size)) in sorted(removed.items())),
+                reclaimed / 1048576, duration, kept))
+        else:
+            logger.debug("Nothing to remove, {:.1f} MB kept, checked in {:.2f}s".format(kept, duration))
+        return reclaimed
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+import itertools
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from util import plural
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_EVENT = 0
+PRIORITY_THUMBNAIL = 1
+PRIORITY_ORIGINAL = 2
+PRIORITY_BACKFILL = 3
+
+# Names for each priority, used to label metrics
+CLASSES = {PRIORITY_EVENT: "event",
+           PRIORITY_THUMBNAIL: "thumbnail",
+           PRIORITY_ORIGINAL: "original",
+           PRIORITY_BACKFILL: "backfill"}
+
+MIN_WORKERS = 1
+MAX_WORKERS = 3
+
+
+class DownloadScheduler:
+    """Runs download jobs on a small pool of worker threads.
+
+    Jobs are taken from a priority queue so that events are fetched before
+    thumbnails, thumbnails before originals and a forced download of all
+    recordings last. The number of worker threads is the number of requests
+    in flight against the camera at once and is kept between MIN_WORKERS and
+    MAX_WORKERS so the device is not overloaded. When several cameras are
+    run together each job also takes a slot from a budget shared between
+    them, see share().
+    """
+
+    def __init__(self, workers=1):
+        self.workers = max(MIN_WORKERS, min(MAX_WORKERS, int(workers)))
+        self.queue = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        self.threads = []
+        self.lock = threading.Lock()
+        self.active = 0
+        self.budget = None
+        self.owner = None
+        self.reset_statistics()
+
+    def share(self, budget, owner):
+        """Take a slot from budget, a FairBudget shared with other cameras, for each job run for owner."""
+        self.budget = budget
+        self.owner = owner
+
+    def start(self):
+        while len(self.threads) < self.workers:
+            name = "download-{}".format(len(self.threads))
+            thread = threading.Thread(target=self.worker, name="{}-{}".format(self.owner, name) if self.owner else name, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def acquire_slot(self):
+        if self.budget is not None:
+            self.budget.acquire(self.owner)
+
+    def release_slot(self):
+        if self.budget is not None:
+            self.budget.release(self.owner)
+
+    def submit(self, priority, function, *args):
+        """Queue a job and return a Future for its result."""
+        self.start()
+        future = Future()
+        self.queue.put((priority, next(self.sequence), future, function, args))
+        return future
+
+    def worker(self):
+        if self.owner:
+            registry.bind(camera=self.owner)
+        while True:
+            (priority, sequence, future, function, args) = self.queue.get()
+            if future.set_running_or_notify_cancel():
+                self.acquire_slot()
+                self.job_started()
+                try:
+                    future.set_result(function(*args))
+                except Exception as e:
+                    future.set_exception(e)
+                finally:
+                    self.job_finished()
+                    self.release_slot()
+            self.queue.task_done()
+
+    def job_started(self):
+        with self.lock:
+            if self.active == 0:
+                self.busy_since = time.monotonic()
+            self.active += 1
+
+    def job_finished(self):
+        with self.lock:
+            self.active -= 1
+            if self.active == 0:
+                self.busy_seconds += time.monotonic() - self.busy_since
+
+    def record(self, size):
+        """Account for a completed download of size bytes."""
+        with self.lock:
+            self.files += 1
+            self.bytes += size
+
+    def reset_statistics(self):
+        with self.lock:
+            self.files = 0
+            self.bytes = 0
+            self.busy_seconds = 0.0
+            self.busy_since = time.monotonic()
+
+    def report(self):
+        """Log the aggregate throughput since the last report and reset it.
+
+        Returns the number of files and bytes downloaded.
+        """
+        with self.lock:
+            busy = self.busy_seconds
+            if self.active > 0:
+                busy += time.monotonic() - self.busy_since
+            (files, size) = (self.files, self.bytes)
+        registry.set("dado_download_throughput_bytes_per_second", size / busy if files > 0 and busy > 0 else 0.0)
+        if files > 0:
+            rate = size / busy / 1048576 if busy > 0 else 0.0
+            logger.info("Downloaded {} file{} ({:.1f} MB) in {:.1f}s at {:.2f} MB/s using {} connection{}".format(
+                files, plural(files), size / 1048576, busy, rate, self.workers, plural(self.workers)))
+        self.reset_statistics()
+        return (files, size)
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+import os.path
+import os
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections.abc import Mapping, MutableMapping
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, status TEXT NOT NULL, size INTEGER NOT NULL, updated REAL NOT NULL,
+                                  kind TEXT, recorded REAL, protected INTEGER NOT NULL DEFAULT 0);
+CREATE TABLE IF NOT EXISTS image_diffs (path TEXT NOT NULL, previous TEXT NOT NULL, settings TEXT NOT NULL, image_diff REAL NOT NULL,
+                                        PRIMARY KEY (path, previous, settings));
+CREATE TABLE IF NOT EXISTS merges (path TEXT PRIMARY KEY, status INTEGER NOT NULL, recordings INTEGER NOT NULL, updated REAL NOT NULL);
+"""
+
+# Columns added to the files table since it was first created
+FILE_COLUMNS = {
+    "kind": "TEXT",
+    "recorded": "REAL",
+    "protected": "INTEGER NOT NULL DEFAULT 0",
+}
+
+UPSERT_FILE = """INSERT INTO files (path, status, size, updated, kind, recorded, protected) VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (path) DO UPDATE SET status = excluded.status, size = excluded.size, updated = excluded.updated,
+    kind = COALESCE(excluded.kind, files.kind), recorded = COALESCE(excluded.recorded, files.recorded),
+    protected = MAX(files.protected, excluded.protected)"""
+
+
+def encode(value):
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    if isinstance(value, Mapping):
+        # e.g. a row of a RecordingCatalog
+        return dict(value)
+    raise TypeError("Object of type {} is not JSON serializable".format(type(value).__name__))
+
+
+def decode(value):
+    if "__datetime__" in value:
+        return datetime.fromisoformat(value["__datetime__"])
+    return value
+
+
+def recorded_time(item):
+    """Return the time a recording started as epoch seconds, if known."""
+    started = item.get('startdatetime')
+    return started.timestamp() if isinstance(started, datetime) else None
+
+
+class StateStore(MutableMapping):
+    """Daemon state that survives a restart.
+
+    Behaves as the dictionary previously used for the state, writing each
+    change through to an SQLite database. Alongside the state it records
+    the download status, kind, size and recording time of local files, the
+    image differences calculated by motion detection and the merges that
+    have been completed. Writes are made in transactions against a write
+    ahead log so a crash leaves the last committed state intact.
+
+    A value set with hold() is kept aside, neither seen nor written until
+    commit() is called, e.g. once the work it records has been finished,
+    and is dropped by discard().
+    """
+
+    def __init__(self, path):
+        if path != ":memory:":
+            directory = os.path.dirname(path)
+            if directory and not os.path.exists(directory):
+                logger.debug("Making dir {}".format(directory))
+                os.makedirs(directory)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=FULL")
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+        self.migrate()
+
+        self.data = {}
+        self.held = {}
+        for (key, value) in self.connection.execute("SELECT key, value FROM state"):
+            self.data[key] = json.loads(value, object_hook=decode)
+        if 'last_image_processed' in self.data:
+            logger.info("Resuming from recording ending {}".format(self.data['last_image_processed']['enddatetime']))
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)",
+                                    (key, json.dumps(value, default=encode)))
+        self.data[key] = value
+        self.held.pop(key, None)
+
+    def __delitem__(self, key):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM state WHERE key = ?", (key,))
+        del self.data[key]
+        self.held.pop(key, None)
+
+    def hold(self, key, value):
+        """Set a value that is only seen and written once commit() is called."""
+        self.held[key] = value
+
+    def commit(self):
+        """Write the values set with hold()."""
+        (held, self.held) = (self.held, {})
+        for (key, value) in held.items():
+            self[key] = value
+
+    def discard(self):
+        """Drop the values set with hold() since the last commit()."""
+        self.held = {}
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def migrate(self):
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(files)")]
+        diff_columns = [row[1] for row in self.connection.execute("PRAGMA table_info(image_diffs)")]
+        with self.connection:
+            if "settings" not in diff_columns:
+                # The settings that calculated earlier differences are not known, so they are calculated again
+                self.connection.execute("DROP TABLE image_diffs")
+                self.connection.executescript(SCHEMA)
+            for (column, definition) in FILE_COLUMNS.items():
+                if column not in columns:
+                    self.connection.execute("ALTER TABLE files ADD COLUMN {} {}".format(column, definition))
+            self.connection.execute("CREATE INDEX IF NOT EXISTS files_recorded ON files (recorded)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS image_diffs_previous ON image_diffs (previous)")
+
+    def record_downloads(self, list, local_key, kind=None, protected=False):
+        """Record the status and size of each local file in list.
+
+        kind is the class of file (event, thumbnail, original or recording),
+        the time of the recording is kept to judge its age and protected
+        files are never removed to keep within the disk quota.
+        """
+        now = time.time()
+        rows = [(item[local_key], item.get('download_status', 'unknown'), item.get('download_size', 0), now,
+                 kind, recorded_time(item), int(protected))
+                for item in list if local_key in item]
+        with self.lock, self.connection:
+            self.connection.executemany(UPSERT_FILE, rows)
+
+    def record_file(self, path, kind, size, recorded, protected=False):
+        with self.lock, self.connection:
+            self.connection.execute(UPSERT_FILE, (path, 'complete', size, time.time(), kind, recorded, int(protected)))
+
+    def index_files(self, rows):
+        """Add files found on disk as (path, kind, size, recorded, protected), keeping what is already known."""
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany("""INSERT INTO files (path, status, size, updated, kind, recorded, protected) VALUES (?, 'complete', ?, ?, ?, ?, ?)
+                ON CONFLICT (path) DO UPDATE SET kind = COALESCE(files.kind, excluded.kind),
+                    recorded = COALESCE(files.recorded, excluded.recorded), protected = MAX(files.protected, excluded.protected)""",
+                                        [(path, size, now, kind, recorded, int(protected)) for (path, kind, size, recorded, protected) in rows])
+
+    def stored_files(self):
+        """Return the number and total size of the files on disk, by kind."""
+        with self.lock:
+            rows = self.connection.execute("SELECT kind, COUNT(*), SUM(size) FROM files WHERE status = 'complete' GROUP BY kind").fetchall()
+        return {kind: (count, size or 0) for (kind, count, size) in rows}
+
+    def files_recorded_before(self, kind, before):
+        """Return the (path, size) of files of a kind recorded before the epoch time before."""
+        with self.lock:
+            return self.connection.execute("SELECT path, size FROM files WHERE status = 'complete' AND kind = ? AND recorded < ?",
+                                           (kind, before)).fetchall()
+
+    def removable_files(self):
+        """Return the (path, kind, size) of unprotected files, oldest recording first."""
+        with self.lock:
+            return self.connection.execute("""SELECT path, kind, size FROM files WHERE status = 'complete' AND protected = 0
+                AND kind IS NOT NULL AND kind != 'event' ORDER BY recorded, path""").fetchall()
+
+    def forget_files(self, paths):
+        with self.lock, self.connection:
+            self.connection.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in paths])
+            # Differences involving removed thumbnails are not needed again
+            self.connection.executemany("DELETE FROM image_diffs WHERE path = ?1 OR previous = ?1", [(path,) for path in paths])
+
+    def record_image_diff(self, path, previous, settings, image_diff):
+        self.record_image_diffs([(path, previous, image_diff)], settings)
+
+    def record_image_diffs(self, rows, settings):
+        """Record differences given as (path, previous, image_diff), calculated by a differ with settings."""
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO image_diffs (path, previous, settings, image_diff) VALUES (?, ?, ?, ?)",
+                                        [(path, previous, settings, float(image_diff)) for (path, previous, image_diff) in rows])
+
+    def image_diff(self, path, previous, settings):
+        """Return the difference previously calculated between two images with the same settings, or None."""
+        with self.lock:
+            row = self.connection.execute("SELECT image_diff FROM image_diffs WHERE path = ? AND previous = ? AND settings = ?",
+                                          (path, previous, settings)).fetchone()
+        return row[0] if row else None
+
+    def record_merge(self, path, status, recordings):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO merges (path, status, recordings, updated) VALUES (?, ?, ?, ?)",
+                                    (path, int(status), recordings, time.time()))
@@ -0,0 +1,5 @@
+import os.path
+import sys
+
+# The modules import each other by name from the dado directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,112 @@
+import shutil
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import motiondetection
+from motiondetection import MotionDetection
+from statestore import StateStore
+
+START = datetime(2020, 1, 1)
+MOVING = range(15, 28)
+
+
+def make_thumbnails(directory, count=40):
+    """Write thumbnails as the fake camera makes them, with movement in MOVING, returning their items.
+
+    The thumbnails are written to a camera directory and only copied to
+    the path of the item when fetched, as they are downloaded by a pass.
+    """
+    (directory / "camera").mkdir(parents=True, exist_ok=True)
+    base = np.random.default_rng(0).integers(0, 256, (180, 320, 3), dtype=np.uint8)
+    items = []
+    for index in range(count):
+        pixels = base
+        if index in MOVING:
+            rng = np.random.default_rng(index)
+            pixels = np.roll(base, int(rng.integers(8, 64)), axis=1) // 2 + rng.integers(0, 128, base.shape, dtype=np.uint8)
+        name = "{:03d}_T.jpg".format(index)
+        Image.fromarray(pixels).save(str(directory / "camera" / name), format="JPEG", quality=85)
+        items.append({"camera_thumbnail": str(directory / "camera" / name),
+                      "thumbnail": str(directory / name),
+                      "startdatetime": START + timedelta(minutes=index),
+                      "enddatetime": START + timedelta(minutes=index + 1),
+                      "start_timestamp": str(index)})
+    return items
+
+
+def make_config(**options):
+    config = {"sensitivity": 1500, "start_count": 3, "stop_count": 3, "maximum_video_length": 1800}
+    config.update(options)
+    return config
+
+
+def find_requests(config, items, state):
+    """Run motion detection as a pass does, returning the requests as start and end times and the thumbnails fetched."""
+    motion = MotionDetection(config, state)
+    fetched = []
+
+    def fetch(list):
+        for item in list:
+            shutil.copyfile(item['camera_thumbnail'], item['thumbnail'])
+        fetched.extend(list)
+        return list
+    if config.get('sample_interval', 1) > 1:
+        motion.sample_thumbnails(items, "thumbnail", fetch)
+    else:
+        fetch(items)
+    motion.calculate_differences(items, "thumbnail")
+    requests = [(request['startdatetime'], request['enddatetime']) for request in motion.identify_requests(items)]
+    return (requests, fetched, motion)
+
+
+def test_sampling_calibrates_first(tmp_path):
+    expected = find_requests(make_config(engine="legacy"), make_thumbnails(tmp_path / "legacy"), StateStore(":memory:"))[0]
+    assert expected
+
+    state = StateStore(":memory:")
+    (requests, fetched, motion) = find_requests(make_config(engine="fast", calibrate=True, sample_interval=5),
+                                                make_thumbnails(tmp_path), state)
+    assert requests == expected
+    assert state['calibrated_score_scale']['4'] == motion.differ.score_scale
+    assert len(fetched) < 40
+
+
+def test_calibrated_scale_is_kept(tmp_path, monkeypatch):
+    state = StateStore(":memory:")
+    state['calibrated_score_scale'] = {'4': 50.0}
+
+    def fail(paths, differ):
+        raise AssertionError("calibrated again")
+    monkeypatch.setattr(motiondetection, "calibrate", fail)
+    (requests, fetched, motion) = find_requests(make_config(engine="fast", calibrate=True, sample_interval=5),
+                                                make_thumbnails(tmp_path), state)
+    assert motion.differ.score_scale == 50.0
+    assert requests
+
+
+def test_recalibrate_measures_once(tmp_path, monkeypatch):
+    state = StateStore(":memory:")
+    state['calibrated_score_scale'] = {'4': 50.0}
+    calls = []
+
+    def measure(paths, differ):
+        calls.append(len(paths))
+        return 60.0
+    monkeypatch.setattr(motiondetection, "calibrate", measure)
+    (requests, fetched, motion) = find_requests(make_config(engine="fast", calibrate=True, recalibrate=True, sample_interval=5),
+                                                make_thumbnails(tmp_path), state)
+    assert len(calls) == 1
+    assert state['calibrated_score_scale']['4'] == motion.differ.score_scale == 60.0
+
+
+@pytest.mark.parametrize("calibrate", [False, True])
+def test_sampling_without_a_scale_fetches_everything(tmp_path, monkeypatch, calibrate):
+    # Calibration that finds nothing to measure leaves the scale unsettled
+    monkeypatch.setattr(motiondetection, "calibrate", lambda paths, differ: None)
+    items = make_thumbnails(tmp_path)
+    (requests, fetched, motion) = find_requests(make_config(engine="fast", calibrate=calibrate, sample_interval=5), items, StateStore(":memory:"))
+    assert len(fetched) == len(items)
+    assert all(item['sampled'] for item in items)
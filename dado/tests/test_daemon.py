@@ -0,0 +1,18 @@
+from types import SimpleNamespace
+
+import pytest
+
+from dado import Dado
+
+
+def test_daemon_closes_the_camera_when_it_stops():
+    closed = []
+    dado = Dado.__new__(Dado)
+    dado.camera = SimpleNamespace(close=lambda: closed.append(True))
+
+    def run_pass():
+        raise RuntimeError("camera went away")
+    dado.run_pass = run_pass
+    with pytest.raises(RuntimeError):
+        dado.run_daemon()
+    assert closed == [True]
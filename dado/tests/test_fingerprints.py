@@ -0,0 +1,31 @@
+import numpy as np
+
+from fingerprints import FingerprintCache
+
+
+def stored_bytes(cache):
+    return cache.connection.execute("SELECT COALESCE(SUM(LENGTH(data)), 0) FROM fingerprints").fetchone()[0]
+
+
+def test_workers_sharing_a_cache_keep_within_its_limit(tmp_path):
+    frame = np.zeros((10, 100), dtype=np.uint8)
+    path = str(tmp_path / "fingerprints.sqlite")
+    # One cache for each worker of a motion pool, all opened before any frames are written
+    workers = [FingerprintCache(path, 20000) for worker in range(4)]
+    for index in range(40):
+        image = tmp_path / "{}.jpg".format(index)
+        image.write_bytes(b"thumbnail")
+        workers[index % len(workers)].put(str(image), 4, frame)
+        assert stored_bytes(workers[0]) <= 20000
+    assert workers[0].total_size() == stored_bytes(workers[0])
+
+
+def test_existing_cache_is_measured(tmp_path):
+    path = str(tmp_path / "fingerprints.sqlite")
+    image = tmp_path / "0.jpg"
+    image.write_bytes(b"thumbnail")
+    FingerprintCache(path, 20000).put(str(image), 4, np.zeros((10, 100), dtype=np.uint8))
+    cache = FingerprintCache(path, 20000)
+    with cache.connection:
+        cache.connection.execute("DROP TABLE totals")
+    assert FingerprintCache(path, 20000).total_size() == 1000
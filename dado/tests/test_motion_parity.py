@@ -0,0 +1,97 @@
+import copy
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+from catalog import RecordingCatalog
+from motiondetection import MotionDetection
+from statestore import StateStore
+
+START = datetime(2020, 1, 1)
+SENSITIVITY = 10
+
+
+def make_items(diffs):
+    """Return one minute recordings with the given image_diff, None leaving it unset."""
+    items = []
+    for (index, image_diff) in enumerate(diffs):
+        item = {"startdatetime": START + timedelta(minutes=index),
+                "enddatetime": START + timedelta(minutes=index + 1),
+                "start_timestamp": str(index)}
+        if image_diff is not None:
+            item['image_diff'] = image_diff
+        items.append(item)
+    return items
+
+
+def make_catalog(diffs):
+    epoch = int(START.timestamp())
+    catalog = RecordingCatalog([{"starttime": epoch + index * 60, "endtime": epoch + (index + 1) * 60} for index in range(len(diffs))])
+    catalog.set_formats({'start_timestamp': ('startdatetime', "%H%M")})
+    for (index, image_diff) in enumerate(diffs):
+        if image_diff is not None:
+            catalog[index]['image_diff'] = image_diff
+    return catalog
+
+
+def identify(engine, config, list):
+    """Return the requests found by an engine and the last image processed, as start times."""
+    state = StateStore(":memory:")
+    motion = MotionDetection(config, state)
+    requests = getattr(motion, "identify_requests_" + engine)(list)
+    found = [(request['startdatetime'], request['enddatetime'], request['start']['startdatetime'],
+              request['end']['startdatetime'], request['event']) for request in requests]
+    state.commit()
+    last = state.get('last_image_processed')
+    return (found, last['startdatetime'] if last else None)
+
+
+def make_config(start_count, stop_count, maximum_video_length):
+    return {"sensitivity": SENSITIVITY, "start_count": start_count, "stop_count": stop_count,
+            "maximum_video_length": maximum_video_length, "engine": "legacy"}
+
+
+def random_cases(seed, count):
+    generator = random.Random(seed)
+    for case in range(count):
+        diffs = []
+        for index in range(generator.randint(0, 40)):
+            draw = generator.random()
+            diffs.append(SENSITIVITY * 2 if draw < 0.45 else 0 if draw < 0.9 else None)
+        config = make_config(generator.randint(-1, 4), generator.randint(-1, 4), generator.choice([60, 180, 600, 100000]))
+        yield (config, diffs)
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_random_lists(seed):
+    for (config, diffs) in random_cases(seed, 1000):
+        items = make_items(diffs)
+        expected = identify("legacy", config, copy.deepcopy(items))
+        assert identify("vectorized", config, copy.deepcopy(items)) == expected, (config, diffs)
+
+
+@pytest.mark.parametrize("seed", range(2))
+def test_random_catalogs(seed):
+    for (config, diffs) in random_cases(100 + seed, 250):
+        expected = identify("legacy", config, make_items(diffs))
+        assert identify("vectorized", config, make_catalog(diffs)) == expected, (config, diffs)
+
+
+@pytest.mark.parametrize("diffs", [
+    [],
+    [0],
+    [20],
+    [0] * 10,
+    [20] * 10,
+    [0, 20, 20, 20, 20, 20, 0, 0, 0, 0, 0],
+    [20, 20, 20, 20, 20, 0, 20, 0, 0, 0, 0, 0],
+    [0, 0, 20, 20, 20, 20, 20, 20, 20, 20],
+    [None, 20, None, 20, 20, 20, 20, None, 0, 0, 0, 0],
+])
+@pytest.mark.parametrize("maximum_video_length", [180, 100000])
+def test_edge_cases(diffs, maximum_video_length):
+    config = make_config(3, 3, maximum_video_length)
+    items = make_items(diffs)
+    expected = identify("legacy", config, copy.deepcopy(items))
+    assert identify("vectorized", config, copy.deepcopy(items)) == expected
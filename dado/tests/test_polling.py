@@ -0,0 +1,9 @@
+from polling import PollScheduler
+
+
+def test_unreachable_interval_stops_at_the_maximum():
+    scheduler = PollScheduler({'sleep_interval': 300, 'polling': {'unreachable_interval': 30.0}})
+    intervals = [scheduler.next_interval(False, 0, False)[0] for attempt in range(2000)]
+    assert intervals[:6] == [30, 60, 120, 240, 300, 300]
+    assert intervals[-1] == 300
+    assert scheduler.failures == 2000
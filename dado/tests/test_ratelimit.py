@@ -0,0 +1,25 @@
+from datetime import datetime, time
+
+import pytest
+
+from ratelimit import RateLimiter, parse_time
+
+
+@pytest.mark.parametrize("value", ["22:30", " 22:30", 1350, time(22, 30)])
+def test_parse_time(value):
+    assert parse_time(value) == time(22, 30)
+
+
+@pytest.mark.parametrize("value", ["22.30", "25:00", 1440, -1, 22.5, True, None])
+def test_parse_time_rejects(value):
+    with pytest.raises(ValueError):
+        parse_time(value)
+
+
+def test_schedule_across_midnight():
+    # As YAML reads an unquoted 22:30 and 6:00
+    limiter = RateLimiter({'original': 100, 'schedule': [{'start': 1350, 'end': 360, 'original': 10}]})
+    assert limiter.rates(datetime(2020, 1, 1, 23, 0))['original'] == 10
+    assert limiter.rates(datetime(2020, 1, 1, 5, 59, 30))['original'] == 10
+    assert limiter.rates(datetime(2020, 1, 1, 6, 0))['original'] == 100
+    assert limiter.rates(datetime(2020, 1, 1, 12, 0))['original'] == 100
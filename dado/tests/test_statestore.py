@@ -0,0 +1,23 @@
+from statestore import StateStore
+
+
+def test_held_value_is_only_seen_once_committed():
+    state = StateStore(":memory:")
+    state['last_image_processed'] = 1
+    state.hold('last_image_processed', 2)
+    assert state['last_image_processed'] == 1
+    state.commit()
+    assert state['last_image_processed'] == 2
+    state.hold('last_image_processed', 3)
+    state.discard()
+    state.commit()
+    assert state['last_image_processed'] == 2
+
+
+def test_forgotten_thumbnails_drop_their_differences():
+    state = StateStore(":memory:")
+    state.record_image_diffs([("b", "a", 1.0), ("c", "b", 2.0), ("d", "c", 3.0)], "legacy")
+    state.forget_files(["b"])
+    assert state.image_diff("b", "a", "legacy") is None
+    assert state.image_diff("c", "b", "legacy") is None
+    assert state.image_diff("d", "c", "legacy") == 3.0
@@ -0,0 +1,38 @@
+from types import SimpleNamespace
+
+import ffmpeg
+import numpy as np
+
+import trimming
+from trimming import MotionTrimmer
+
+CONFIG = {'motion_detection': {'sensitivity': 1500}, 'trimming': {'enabled': True}}
+
+
+def test_frames_are_scored_on_the_scale_of_motion_detection(monkeypatch):
+    motion = SimpleNamespace(differ=SimpleNamespace(score_scale=40.0))
+    trimmer = MotionTrimmer(CONFIG, motion)
+    monkeypatch.setattr(trimmer, "frames", lambda path: np.zeros((3, 36, 64), dtype=np.uint8))
+    trimmer.changes("recording.mp4")
+    assert trimmer.differ.score_scale == 40.0
+    # Calibration later in the run is followed
+    motion.differ.score_scale = 55.0
+    trimmer.changes("recording.mp4")
+    assert trimmer.differ.score_scale == 55.0
+
+
+def test_failed_cut_removes_the_temporary_file(tmp_path, monkeypatch):
+    final_file = tmp_path / "merged.mp4"
+    final_file.write_bytes(b"merged")
+    trimmed_file = tmp_path / "merged.trimmed.mp4"
+    trimmer = MotionTrimmer(CONFIG)
+    monkeypatch.setattr(trimming, "mp4_duration", lambda path: 60.0)
+    monkeypatch.setattr(trimmer, "changes", lambda path: (40.0, 50.0))
+
+    def run(stream, **kwargs):
+        trimmed_file.write_bytes(b"partial")
+        raise ffmpeg.Error("ffmpeg", b"", b"Conversion failed!")
+    monkeypatch.setattr(ffmpeg.nodes.OutputStream, "run", run)
+    assert trimmer.trim(str(final_file), [str(final_file)]) is None
+    assert not trimmed_file.exists()
+    assert final_file.read_bytes() == b"merged"
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+import os.path
+import os
+import logging
+import struct
+
+import ffmpeg
+import numpy as np
+
+from imagediff import FrameDiffer, SCORE_SCALE
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+
+def mp4_duration(path):
+    """Return the duration in seconds recorded in the movie header of an MP4 file, or None."""
+    try:
+        with open(path, 'rb') as f:
+            end = os.fstat(f.fileno()).st_size
+            # The movie header is inside the moov box at the top level
+            for name in (b'moov', b'mvhd'):
+                while True:
+                    header = f.read(8)
+                    if len(header) < 8:
+                        return None
+                    (size, kind) = struct.unpack(">I4s", header)
+                    start = f.tell() - 8
+                    if size == 1:
+                        (size,) = struct.unpack(">Q", f.read(8))
+                    elif size == 0:
+                        size = end - start
+                    if size < 8 or start + size > end:
+                        return None
+                    if kind == name:
+                        end = start + size
+                        break
+                    f.seek(start + size)
+            version = f.read(4)[0]
+            if version == 1:
+                (timescale, duration) = struct.unpack(">16xIQ", f.read(28))
+            else:
+                (timescale, duration) = struct.unpack(">8xII", f.read(16))
+    except (OSError, struct.error, IndexError):
+        return None
+    if not timescale:
+        return None
+    return duration / timescale
+
+
+class MotionTrimmer:
+    """Trims the minutes without motion from the ends of merged recordings.
+
+    Motion detection compares one thumbnail per recording, so a merged
+    recording can start and end with most of a recording in which nothing
+    moves. Recordings are decoded by ffmpeg into small grayscale frames at
+    trimming.fps frames a second, read from a pipe, and compared in one
+    operation by the FrameDiffer used for thumbnails, stepping in from
+    each end until one with a change over trimming.sensitivity is found,
+    as a request usually ends with a recording or more without one. The
+    merged recording is then cut with stream copy from
+    trimming.margin_seconds before the first change to as long after the
+    last one. As streams are copied, the cut starts at the key frame
+    before the first change, so a little more is kept. Frames are scored
+    with the score_scale in use by motion, which may have been calibrated.
+    """
+
+    def __init__(self, config, motion=None):
+        self.config = config
+        self.motion = motion
+        self.trimming = config.get('trimming') or {}
+        motion_config = config.get('motion_detection') or {}
+        self.fps = self.trimming.get('fps', 2)
+        self.size = (self.trimming.get('width', 64), self.trimming.get('height', 36))
+        self.margin = self.trimming.get('margin_seconds', 10)
+        self.sensitivity = self.trimming.get('sensitivity') or motion_config['sensitivity']
+        self.differ = FrameDiffer({'score_scale': motion_config.get('score_scale') or SCORE_SCALE})
+
+    def score_scale(self):
+        """Return the score_scale used by motion detection, as calibration may have changed it since start up."""
+        return getattr(getattr(self.motion, 'differ', None), 'score_scale', None) or self.differ.score_scale
+
+    def frames(self, path):
+        """Return the frames of a recording as an array of small grayscale images."""
+        (width, height) = self.size
+        (output, error) = ffmpeg.input(path).filter('fps', fps=self.fps).filter('scale', width, height) \
+            .output('pipe:', format='rawvideo', pix_fmt='gray') \
+            .global_args('-loglevel', 'error') \
+            .run(capture_stdout=True, capture_stderr=True)
+        return np.frombuffer(output, dtype=np.uint8).reshape(-1, height, width)
+
+    def changes(self, path):
+        """Return the times in seconds between which frames of a recording change, or None if none do."""
+        frames = self.frames(path)
+        self.differ.score_scale = self.score_scale()
+        changed = np.flatnonzero(self.differ.differences(frames) > self.sensitivity)
+        if len(changed) == 0:
+            return None
+        # Difference i is between the frames at i / fps and (i + 1) / fps
+        return (float(changed[0]) / self.fps, float(changed[-1] + 1) / self.fps)
+
+    def trim(self, final_file, recordings):
+        """Cut the merged file of recordings to the motion in them, returning the part kept or None if it was not trimmed."""
+        with registry.stage("trim"):
+            try:
+                return self.cut(final_file, recordings)
+            except (ffmpeg.Error, OSError, ValueError) as e:
+                error = getattr(e, 'stderr', None)
+                if error and error.strip():
+                    # The last line of ffmpeg's output says what went wrong
+                    e = error.decode(errors='replace').strip().splitlines()[-1]
+                logger.warning("Not trimming {}: {}".format(final_file, e))
+                return None
+
+    def find_change(self, recordings, indexes, changes):
+        """Return the first of indexes whose recording changes and the seconds of the recordings before it.
+
+        The index is None if none of them change, or one that does not has
+        no known duration. The changes found are kept in changes by index.
+        """
+        skipped = 0.0
+        for index in indexes:
+            if index not in changes:
+                changes[index] = self.changes(recordings[index])
+            if changes[index]:
+                return (index, skipped)
+            duration = mp4_duration(recordings[index])
+            if duration is None:
+                break
+            skipped += duration
+        return (None, skipped)
+
+    def cut(self, final_file, recordings):
+        total = mp4_duration(final_file)
+        if total is None:
+            logger.debug("Not trimming {}, its duration is not known".format(final_file))
+            return None
+        # Step in from each end over the recordings without a change, to the first and last with one
+        changes = {}
+        (first, skipped) = self.find_change(recordings, range(len(recordings)), changes)
+        if first is None:
+            logger.debug("Not trimming {}, no change was found before a recording of unknown duration or the end".format(final_file))
+            return None
+        start = max(0.0, skipped + changes[first][0] - self.margin)
+        (last, skipped) = self.find_change(recordings, range(len(recordings) - 1, first - 1, -1), changes)
+        duration = mp4_duration(recordings[last]) if last is not None else None
+        end = total
+        if duration is not None:
+            end = min(total, total - skipped - duration + changes[last][1] + self.margin)
+        if end <= start or (start < 1.0 / self.fps and end > total - 1.0 / self.fps):
+            logger.debug("Nothing to trim from {}".format(final_file))
+            return None
+
+        size = os.stat(final_file).st_size
+        (root, extension) = os.path.splitext(final_file)
+        trimmed_file = root + ".trimmed" + extension
+        input_args = {'ss': "{:.3f}".format(start)} if start > 0 else {}
+        try:
+            ffmpeg.input(final_file, **input_args).output(trimmed_file, c='copy', t="{:.3f}".format(end - start)) \
+                .global_args('-loglevel', self.config.get('ffmpeg_log_level', 'info')) \
+                .global_args('-y').run()
+            os.replace(trimmed_file, final_file)
+        except BaseException:
+            # Leave no partly written cut behind
+            if os.path.exists(trimmed_file):
+                os.remove(trimmed_file)
+            raise
+
+        removed = total - (end - start)
+        saved = size - os.stat(final_file).st_size
+        registry.inc("dado_trimmed_seconds_total", removed)
+        registry.inc("dado_trimmed_bytes_total", max(saved, 0))
+        logger.info("Trimmed {:.0f}s without motion from the start and {:.0f}s from the end of {}, saving {:.1f} MB".format(
+            start, total - end, final_file, saved / 1048576))
+        return {"start": round(start, 3), "end": round(end, 3), "duration": round(total, 3)}